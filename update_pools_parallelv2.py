@@ -4,22 +4,47 @@
 Bulk update the 'pools' key inside Verus ccminer config across multiple hosts using SSH and a common password. Features include:
  - Remote config backup w/pruning. Will create a folder and store 5 versions of your last changed config with the original version saved as config.json.orig
  - Disable or enable a pool URL, or replace the entire pools list from a JSON file
- - switchpool trigger via telnet on localhost:4068 (remote) - Must have api enabled. Script will function minus switchpool if no api access.
- - Concurrent SSH connections (default workers=10)
+ - switchpool trigger on localhost:4068 (remote) over an SSH direct-tcpip channel, falling back to telnet - Must have api enabled. Script will function minus switchpool if no api access.
+ - Concurrent SSH connections (default workers=10, or `--workers auto` to tune them per network segment)
  - Only tested on Linux/Termux- Written for interacting with Termux specifically.
 
-**REQUIRES (on system running script):** python and paramiko
+**REQUIRES (on system running script):** python and paramiko (asyncssh for `--engine asyncio`)
 
-**REQUIRES (on target system):** telnet 
+**REQUIRES (on target system):** telnet only if sshd has TCP forwarding disabled (switchpool fallback)
 
 | Command | Description | OP |
 | --- | --- | --- |
-| `--enable-url` | --enable-url "stratum+tcp://ca.vipor.net:5045" | or |
-| `--disable-url` | --disable-url "stratum+tcp://ca.vipor.net:5045" | or |
+| `--enable-url` | --enable-url "stratum+tcp://ca.vipor.net:5045" (repeatable) | or |
+| `--disable-url` | --disable-url "stratum+tcp://ca.vipor.net:5045" (repeatable) | or |
+| `--disable-match` / `--enable-match` | Selector: glob 'stratum+tcp://*.vipor.net:*', 're:<regex>' or 'host:<name>', matched after normalizing case, scheme, trailing slash (repeatable) | or |
+| `--ops-file` | File of `disable`, `enable`, `disable-match` or `enable-match` lines, all applied in one pass per host | or |
 | `--set-pools-json` | --set-pools-json <pools.json> |
-| `--switch-pool` | Trigger via telnet on (remote) localhost:4068 |
-| `--range` | --range 10.10.10.100-10.10.10.200 | or |
-| `--cidr` | --range 10.10.10.0/24 |
+| `--regions` | JSON `{"<cidr>": "<region>", "*": "<default>"}` for `${region}`; strings in --set-pools-json/--patch/--set values may use `${ip}`, `${ip_dashed}`, `${ip_last}`, `${hostname}`, `${region}`, rendered per host and deduplicated (`$${ip}` is a literal `${ip}`; other `${...}` text is left as is) |
+| `--patch` | --patch <ops.json>: JSON array of RFC 6902-style ops (`add`, `replace`, `remove`, `test`, plus `enable-pools`/`disable-pools` with a `match`), compiled once and applied per host in one pass |
+| `--set` | Set one config key, e.g. `--set threads=8` or `--set /pools/0/pass=x`; the value is parsed as JSON, else kept as a string (repeatable) |
+| `--preserve-format` | Splice only the changed values into config.json (keeps hand formatting); 0/1 flips are patched in place on the host |
+| `--remote-edit` | Edit config.json on the host with python or jq in one exec (backup + atomic rename there), normal path when neither exists |
+| `--check-drift` | With --set-pools-json: report only hosts whose pools differ (hash compared remotely, nothing written) |
+| `--push-drifted` | With --check-drift: write --set-pools-json to the drifted hosts only |
+| `--pull` | Snapshot every config.json into a local content-addressed store (--store, default ~/.update_pools_store) with a per-run host manifest |
+| `--switch-pool` | Trigger on (remote) localhost:4068 via SSH tunnel, telnet fallback |
+| `--switch-if-changed` | Only send switchpool to hosts whose config actually changed |
+| `--switch-method` | auto (tunnel, then telnet), tunnel, telnet or nc |
+| `--switchpool-timeout` | Seconds to wait for the ccminer API reply (default 5) |
+| `--probe` | Probe each host once (telnet, nc, python, jq, dd, TCP forwarding), cache per host key in --probe-cache for --probe-ttl seconds and pick switchpool/edit methods from it |
+| `--range` | --range 10.10.10.100-10.10.10.200 (repeatable, a single IP works too) | or |
+| `--cidr` | --cidr 10.10.10.0/24 (repeatable; all --range/--cidr specs are merged, overlaps run once) |
+| `--exclude` | --exclude 10.10.10.128/28 or --exclude 10.10.10.5-10.10.10.9 (repeatable): drop hosts from --range/--cidr/--inventory |
+| `--inventory` | --inventory fleet.csv: header `ip,port,username,password,tags,<attribute>...`; empty cells fall back to --port/--username/--password, tags are space or `;` separated | or |
+| `--select` | With --inventory: `--select tag=rack3,model=s9` (every term must match; repeat for OR), resolved on indexed in-memory SQLite |
+| `--prescan` | TCP-check --port on all targets first, only SSH to hosts that answer |
+| `--include-dead` | Also try hosts that were unreachable on their port on recent runs (connect timeout or no route; a refused port does not count). They are skipped by default for 5 min, doubling per failure up to 24 h, and a run that skips any exits 1; state in --dead-cache, default ~/.update_pools_dead.json. With this flag they run last |
+| `--schedule` | lpt (default): submit hosts longest-expected first within windows of 4096, using per-host run times from earlier runs (--history, default ~/.update_pools_history.json; entries unseen for 30 days are dropped), new hosts interleaved; not applied with --prescan; ip: plain address order |
+| `--workers` | --workers 20, or --workers auto: grow concurrency per /24 while the first remote command's round trip stays flat, halve it on handshake timeouts or latency spikes; the per-segment optimum is reported at the end (- when none was reached). Thread engine and --via-daemon only |
+| `--results-out` | --results-out run.jsonl (one JSON line per host, written as results arrive) |
+| `--trace` | --trace run.json (load in Perfetto / chrome://tracing: one track per worker, one span per host phase) |
+| `--daemon` / `--via-daemon` | Keep SSH sessions to the fleet open in a local daemon (--socket) and send runs through it |
+| `--engine` | --engine asyncio --concurrency 2000 (one event loop instead of a thread per host, needs asyncssh) |
 
 ## Usage examples:
 
@@ -54,63 +79,778 @@ Format your pools.json just like the pools: block including the closing brackets
 
 from __future__ import annotations
 import argparse
+import asyncio
+import copy
+import csv
+import errno
+import gzip
+import hashlib
+import itertools
 import json
+import logging
+import math
+import os
+import queue
+import re
+import shlex
+import signal
+import socket
+import socketserver
+import sqlite3
 import sys
+import threading
 import time
-from ipaddress import ip_network, ip_address
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import List, Optional, Dict, Any, Tuple
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from bisect import bisect_right
+from ipaddress import ip_network, ip_address, IPv4Address, IPv6Address
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Optional, Dict, Any, Tuple, Iterator, Iterable, Callable, Awaitable, FrozenSet, Set, Generator
 
 import paramiko
 
+try:
+    import asyncssh  # optional: only needed for --engine asyncio
+except ImportError:
+    asyncssh = None
+
 # === Remote config paths - Home-relative paths ===
 CONFIG_PATH_RAW = "~/ccminer/config.json"
 BACKUP_DIR_RAW = "~/ccminer/configbackups"
 
+# === Remote ccminer API trigger ===
+CCMINER_API_HOST = "127.0.0.1"
+CCMINER_API_PORT = 4068
+SWITCHPOOL_TIMEOUT = 5  # seconds to wait for the API reply over the tunnel
+SWITCHPOOL_TELNET_CMD = '(echo switchpool; sleep 1) | telnet localhost 4068 2>&1 || true'
+SWITCHPOOL_NC_CMD = '(echo switchpool; sleep 1) | nc localhost 4068 2>&1 || true'
+
+# === URL normalization for --disable-match / --enable-match ===
+DEFAULT_URL_SCHEME = "stratum+tcp"
+URL_SCHEME_ALIASES = {"stratum": "stratum+tcp"}
+URL_MATCH_MEMO_SIZE = 4096  # distinct pool URLs whose match result a UrlMatcher remembers
+
+# === Framing for the single-exec prepare step (see prepare_script) ===
+PREPARE_MARKER = "__UPDATE_POOLS_CONFIG__"
+
 # === Defaults ===
 DEFAULT_SSH_PORT = 8022
 DEFAULT_WORKERS = 10
+DEFAULT_ASYNC_CONCURRENCY = 500
 SSH_CONNECT_TIMEOUT = 10  # seconds
+PRESCAN_TIMEOUT = 1.0  # seconds per TCP connect during --prescan
+PRESCAN_CONCURRENCY = 2000  # connects in flight during --prescan
+SUBMIT_WINDOW_FACTOR = 2  # thread engine keeps at most workers * factor hosts submitted
+AIMD_START = 4  # --workers auto: starting limit per network segment...
+AIMD_MAX_WORKERS = 128  # ...and the cap on hosts in flight across all segments
+AIMD_DECREASE = 0.5  # limit multiplier on a handshake timeout or latency spike
+AIMD_LATENCY_TOLERANCE = 1.5  # round-trip EWMA above baseline x this: stop growing
+AIMD_LATENCY_SPIKE = 2.0  # a single round trip above baseline x this: back off
+AIMD_LATENCY_ALPHA = 0.2  # weight of the newest round trip in the EWMA
+AIMD_INTERLEAVE_WINDOW = 4096  # hosts read ahead and dealt round-robin across segments
+RESULTS_FLUSH_EVERY = 50  # --results-out: flush after this many results...
+RESULTS_FLUSH_INTERVAL = 2.0  # ...or this many seconds, whichever comes first
+FAILURE_DETAILS_LIMIT = 100  # failed hosts listed individually in the summary
+PHASE_HIST_MIN = 1e-4  # seconds; phase timings are bucketed from here up...
+PHASE_HIST_GROWTH = 1.02  # ...in buckets this much wider each, so percentiles are within 2%
+TRANSFORM_CACHE_SIZE = 256  # distinct (config, operation) renders kept in memory
+TEMPLATE_RENDER_CACHE_SIZE = 4096  # distinct per-host renders of templated ops kept per run
+INPLACE_PATCH_MAX_RUNS = 32  # --preserve-format: more changed byte runs than this means a full write
+PHASES = ("tcp_connect", "kex", "auth", "probe", "drift", "prepare", "edit", "write", "switchpool", "total")  # summary row order
+
+
+# === Connection-pool daemon (--daemon / --via-daemon) ===
+DAEMON_KEEPALIVE = 30  # seconds between SSH keepalives on pooled transports
+DAEMON_IDLE_TIMEOUT = 600  # close pooled transports unused for this many seconds
+DAEMON_EVICT_INTERVAL = 30  # how often the idle sweep runs
+DEFAULT_DAEMON_SOCKET = os.path.join(os.path.expanduser("~"), ".update_pools.sock")
+
+# === Per-host capability cache (--probe) ===
+DEFAULT_PROBE_CACHE = os.path.join(os.path.expanduser("~"), ".update_pools_caps.json")
+PROBE_TTL = 86400  # seconds before a host's capabilities are probed again
+PROBE_TOOLS = ("telnet", "nc", "python3", "python", "jq", "dd")
+
+# === Negative cache of unreachable hosts ===
+DEFAULT_DEAD_CACHE = os.path.join(os.path.expanduser("~"), ".update_pools_dead.json")
+DEAD_TTL_BASE = 300  # seconds a host is skipped after its first connect failure...
+DEAD_TTL_MAX = 86400  # ...doubling per consecutive failure up to this
+UNREACHABLE_ERRNOS = frozenset(getattr(errno, name) for name in ("EHOSTUNREACH", "ENETUNREACH", "EHOSTDOWN", "ETIMEDOUT")
+                               if hasattr(errno, name))
+
+# === Per-host duration history (LPT scheduling) ===
+DEFAULT_HISTORY = os.path.join(os.path.expanduser("~"), ".update_pools_history.json")
+HISTORY_EWMA_ALPHA = 0.3  # weight of the newest run in a host's expected duration
+HISTORY_MAX_AGE = 30 * 86400  # history entries not refreshed for this long are dropped on save
+LPT_WINDOW = 4096  # --schedule lpt reorders hosts within consecutive windows of this many
+
+# === Local snapshot store (--pull) ===
+DEFAULT_SNAPSHOT_STORE = os.path.join(os.path.expanduser("~"), ".update_pools_store")
 
 
 # ---------------- utilities ----------------
-def expand_range(range_str: str) -> List[str]:
-    """Expand 'start-end' IPv4 range (inclusive) or return single IP."""
-    if "-" in range_str:
-        start_str, end_str = range_str.split("-", 1)
-        start = int(ip_address(start_str.strip()))
-        end = int(ip_address(end_str.strip()))
-        if end < start:
-            raise ValueError("Range end must be >= start")
-        return [str(ip_address(i)) for i in range(start, end + 1)]
-    else:
-        return [range_str]
+def parse_range(range_str: str) -> Tuple[Any, Any]:
+    """Parse 'start-end' (inclusive, IPv4 or IPv6) into (first, last) address objects."""
+    start_str, end_str = range_str.split("-", 1)
+    start = ip_address(start_str.strip())
+    end = ip_address(end_str.strip())
+    if start.version != end.version:
+        raise ValueError("Range start and end must be the same IP version")
+    if end < start:
+        raise ValueError("Range end must be >= start")
+    return start, end
+
+
+def range_interval(range_str: str) -> Tuple[int, int, int]:
+    """'start-end' (inclusive) or a single address -> (ip version, first, last) as integers."""
+    if "-" not in range_str:
+        addr = ip_address(range_str.strip())
+        return addr.version, int(addr), int(addr)
+    start, end = parse_range(range_str)
+    return start.version, int(start), int(end)
+
+
+def cidr_interval(cidr_str: str, hosts_only: bool = True) -> Tuple[int, int, int]:
+    """CIDR block -> (ip version, first, last). With hosts_only, the same addresses as ipaddress' hosts():
+    network + broadcast dropped on IPv4, only the Subnet-Router anycast address on IPv6, nothing on /31, /32, /127, /128."""
+    net = ip_network(cidr_str, strict=False)
+    first, last = int(net.network_address), int(net.broadcast_address)
+    if hosts_only and net.num_addresses > 2:
+        first += 1
+        if net.version == 4:
+            last -= 1
+    return net.version, first, last
 
 
-def expand_cidr(cidr_str: str) -> List[str]:
-    net = ip_network(cidr_str, strict=False)
-    return [str(ip) for ip in net.hosts()]
+def spec_interval(spec: str, hosts_only: bool = True) -> Tuple[int, int, int]:
+    return cidr_interval(spec, hosts_only) if "/" in spec else range_interval(spec)
+
+
+def merge_intervals(intervals: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Sort and coalesce overlapping or adjacent [first, last] intervals."""
+    merged: List[Tuple[int, int]] = []
+    for first, last in sorted(intervals):
+        if merged and first <= merged[-1][1] + 1:
+            if last > merged[-1][1]:
+                merged[-1] = (merged[-1][0], last)
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def subtract_intervals(include: List[Tuple[int, int]], exclude: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """include minus exclude, both merged and sorted; one sweep over the two lists."""
+    out: List[Tuple[int, int]] = []
+    j = 0
+    for first, last in include:
+        while j < len(exclude) and exclude[j][1] < first:
+            j += 1
+        k = j
+        while k < len(exclude) and exclude[k][0] <= last:
+            if exclude[k][0] > first:
+                out.append((first, exclude[k][0] - 1))
+            first = max(first, exclude[k][1] + 1)
+            k += 1
+        if first <= last:
+            out.append((first, last))
+    return out
+
+
+class AddressSet:
+    """Target hosts as merged integer intervals per IP version.
+
+    Built from any number of include specs (ranges, CIDRs, single addresses)
+    minus exclude specs, in O(intervals); overlapping specs collapse, so no
+    address is yielded twice. Iteration expands lazily in address order
+    (IPv4 first); membership is a bisect.
+    """
+
+    def __init__(self, includes: Iterable[str] = (), excludes: Iterable[str] = (), hosts_only: bool = True):
+        inc: Dict[int, List[Tuple[int, int]]] = {}
+        exc: Dict[int, List[Tuple[int, int]]] = {}
+        for spec in includes:
+            version, first, last = spec_interval(spec, hosts_only)
+            inc.setdefault(version, []).append((first, last))
+        for spec in excludes:
+            version, first, last = spec_interval(spec, hosts_only=False)  # excluding a CIDR drops all of it
+            exc.setdefault(version, []).append((first, last))
+        self.intervals = {version: subtract_intervals(merge_intervals(spans), merge_intervals(exc.get(version, [])))
+                          for version, spans in sorted(inc.items())}
+        self.starts = {version: [first for first, _ in spans] for version, spans in self.intervals.items()}
+
+    def size(self) -> int:
+        """Address count; not __len__, whose result must fit a C ssize_t (a /64 alone is 2**64)."""
+        return sum(last - first + 1 for spans in self.intervals.values() for first, last in spans)
+
+    def __iter__(self) -> Iterator[str]:
+        for version, spans in self.intervals.items():
+            addr_type = IPv4Address if version == 4 else IPv6Address
+            for first, last in spans:
+                for i in range(first, last + 1):
+                    yield str(addr_type(i))
+
+    def __contains__(self, ip: str) -> bool:
+        addr = ip_address(ip)
+        starts = self.starts.get(addr.version)
+        if not starts:
+            return False
+        i = bisect_right(starts, int(addr)) - 1
+        return i >= 0 and int(addr) <= self.intervals[addr.version][i][1]
+
+
+def format_ip_runs(ips: Iterable[str]) -> str:
+    """Collapse addresses into runs, e.g. '10.0.0.1-10.0.0.4, 10.0.0.9'."""
+    addrs = sorted({ip_address(ip) for ip in ips}, key=lambda a: (a.version, int(a)))
+    runs = []
+    i = 0
+    while i < len(addrs):
+        j = i
+        while j + 1 < len(addrs) and addrs[j + 1].version == addrs[i].version and int(addrs[j + 1]) == int(addrs[j]) + 1:
+            j += 1
+        runs.append(str(addrs[i]) if i == j else f"{addrs[i]}-{addrs[j]}")
+        i = j + 1
+    return ", ".join(runs)
+
+
+class HostRuns:
+    """A growing set of addresses kept as runs of consecutive ones, e.g. the dead part of a sweep.
+
+    Memory follows the number of gaps, not hosts: a dark /16 met in
+    (roughly) address order is a handful of runs.
+    """
+
+    def __init__(self):
+        self.runs: List[List[int]] = []  # [version, first, last]
+        self.count = 0
+
+    def add(self, ip: str) -> None:
+        addr = ip_address(ip)
+        self.count += 1
+        last = self.runs[-1] if self.runs else None
+        if last and last[0] == addr.version and last[2] + 1 == int(addr):
+            last[2] = int(addr)
+        else:
+            self.runs.append([addr.version, int(addr), int(addr)])
+
+    def __len__(self) -> int:
+        return self.count
+
+    def format(self) -> str:
+        """Like format_ip_runs(): '10.0.0.1-10.0.0.4, 10.0.0.9'."""
+        merged: List[List[int]] = []
+        for version, first, last in sorted(self.runs):
+            if merged and merged[-1][0] == version and first <= merged[-1][2] + 1:
+                merged[-1][2] = max(merged[-1][2], last)
+            else:
+                merged.append([version, first, last])
+        addr_type = {4: IPv4Address, 6: IPv6Address}
+        return ", ".join(str(addr_type[v](first)) if first == last else f"{addr_type[v](first)}-{addr_type[v](last)}"
+                         for v, first, last in merged)
+
+
+def open_files_budget(reserve: int = 64) -> Optional[int]:
+    """Raise the soft RLIMIT_NOFILE to the hard limit and return how many sockets we can safely hold open.
+    Returns None where the resource module is unavailable (Windows)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    if soft == resource.RLIM_INFINITY:
+        return None
+    return max(1, soft - reserve)
+
+
+# ---------------- host inventory ----------------
+INVENTORY_COLUMNS = ("ip", "port", "username", "password", "tags")  # the rest of the CSV header are attributes
+
+
+def split_target(target: Any) -> Tuple[str, Dict[str, Any]]:
+    """Engine host items are an IP or (ip, {port/username/password overrides}) from --inventory."""
+    if isinstance(target, str):
+        return target, {}
+    return target[0], target[1]
+
+
+def host_job(job_kwargs: Dict[str, Any], overrides: Dict[str, Any]) -> Dict[str, Any]:
+    return dict(job_kwargs, **overrides) if overrides else job_kwargs
+
+
+def parse_select(select: str) -> List[Tuple[str, str]]:
+    """'tag=rack3,model=s9' -> [('tag', 'rack3'), ('model', 's9')]; every term must match."""
+    terms = []
+    for term in select.split(","):
+        key, sep, value = term.partition("=")
+        if not sep or not key.strip() or not value.strip():
+            raise ValueError(f"expected key=value terms, got {term!r}")
+        terms.append((key.strip(), value.strip()))
+    return terms
+
+
+class Inventory:
+    """--inventory CSV loaded into an indexed in-memory SQLite database.
+
+    The header must have an 'ip' column; 'port', 'username' and 'password'
+    override the CLI values per host when set, 'tags' holds space or ';'
+    separated tags, and every other column is a free-form attribute (model,
+    site, ...). select() resolves '--select' terms with indexed lookups, so
+    picking a rack out of 100k rows takes milliseconds.
+    """
+
+    def __init__(self, path: str):
+        started = time.monotonic()
+        self.db = sqlite3.connect(":memory:", check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE hosts (ord INTEGER PRIMARY KEY, ip TEXT, port INTEGER, username TEXT, password TEXT);
+            CREATE TABLE tags (tag TEXT, ip TEXT);
+            CREATE TABLE attrs (key TEXT, value TEXT, ip TEXT);
+        """)
+        hosts, tags, attrs = [], [], []
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            reader = csv.DictReader(f)
+            if not reader.fieldnames or "ip" not in reader.fieldnames:
+                raise ValueError("the inventory CSV needs a header with an 'ip' column")
+            extra = [c for c in reader.fieldnames if c not in INVENTORY_COLUMNS]
+            for lineno, row in enumerate(reader, 2):
+                ip = (row.get("ip") or "").strip()
+                if not ip:
+                    continue
+                try:
+                    socket.inet_pton(socket.AF_INET6 if ":" in ip else socket.AF_INET, ip)
+                    port = int(row["port"]) if (row.get("port") or "").strip() else None
+                except (OSError, ValueError) as e:
+                    raise ValueError(f"{path}:{lineno}: bad ip/port ({e})") from None
+                hosts.append((lineno, ip, port, row.get("username") or None, row.get("password") or None))
+                tags.extend((tag, ip) for tag in re.split(r"[\s;]+", row.get("tags") or "") if tag)
+                attrs.extend((key, row[key].strip(), ip) for key in extra if (row.get(key) or "").strip())
+        with self.db:
+            self.db.executemany("INSERT INTO hosts VALUES (?, ?, ?, ?, ?)", hosts)
+            self.db.executemany("INSERT INTO tags VALUES (?, ?)", tags)
+            self.db.executemany("INSERT INTO attrs VALUES (?, ?, ?)", attrs)
+            # Indexes go on after the bulk insert, which is several times faster than maintaining them row by row
+            try:
+                self.db.execute("CREATE UNIQUE INDEX hosts_by_ip ON hosts (ip)")
+            except sqlite3.IntegrityError:
+                raise ValueError(f"{path}: an ip is listed more than once") from None
+            self.db.execute("CREATE INDEX tags_by_tag ON tags (tag, ip)")
+            self.db.execute("CREATE INDEX attrs_by_value ON attrs (key, value, ip)")
+        self.size = len(hosts)
+        self.load_seconds = time.monotonic() - started
+
+    def _where(self, selects: List[List[Tuple[str, str]]]) -> Tuple[str, List[Any]]:
+        """SQL for hosts matching any --select (each one an AND of its terms); all hosts when there are none.
+
+        The smallest tag/attribute term (counted on its index) drives the query;
+        the others are EXISTS point lookups on (tag|key, value, ip), so the cost
+        follows the size of the smallest match, not of the inventory.
+        """
+        alternatives, params = [], []
+        for terms in selects:
+            clauses = []
+            for key, value in sorted(terms, key=lambda term: self._term_size(*term)):
+                if key in ("ip", "port", "username"):
+                    clauses.append(f"{key} = ?")
+                    params.append(int(value) if key == "port" else value)
+                    continue
+                if key == "tag":
+                    sub = "SELECT ip FROM tags WHERE tag = ?"
+                    params.append(value)
+                else:
+                    sub = "SELECT ip FROM attrs WHERE key = ? AND value = ?"
+                    params.extend((key, value))
+                if any(c.startswith("ip IN") for c in clauses):
+                    clauses.append(f"EXISTS ({sub} AND ip = hosts.ip)")
+                else:
+                    clauses.append(f"ip IN ({sub})")
+            alternatives.append("(" + " AND ".join(clauses) + ")")
+        return (" WHERE " + " OR ".join(alternatives) if alternatives else ""), params
+
+    def _term_size(self, key: str, value: str) -> int:
+        if key == "tag":
+            return self.db.execute("SELECT COUNT(*) FROM tags WHERE tag = ?", (value,)).fetchone()[0]
+        if key in ("ip", "port", "username"):
+            return 0  # plain column filters, applied to whatever the indexed term yields
+        return self.db.execute("SELECT COUNT(*) FROM attrs WHERE key = ? AND value = ?", (key, value)).fetchone()[0]
+
+    def count(self, selects: List[List[Tuple[str, str]]], missing: Optional[str] = None) -> int:
+        """Hosts matched by selects; with missing='username'/'password', only those without that override."""
+        where, params = self._where(selects)
+        if missing:
+            where = (where + " AND" if where else " WHERE") + f" {missing} IS NULL"
+        return self.db.execute("SELECT COUNT(*) FROM hosts" + where, params).fetchone()[0]
+
+    def targets(self, selects: List[List[Tuple[str, str]]]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """Lazily yield (ip, overrides) for the selected hosts in file order."""
+        where, params = self._where(selects)
+        cur = self.db.execute("SELECT ip, port, username, password FROM hosts" + where + " ORDER BY ord", params)
+        for ip, port, username, password in cur:
+            overrides = {k: v for k, v in (("port", port), ("username", username), ("password", password))
+                         if v is not None}
+            yield ip, overrides
+
+
+# ---------------- TCP pre-scan ----------------
+async def tcp_connect_error(ip: str, port: int, timeout: float) -> Optional[BaseException]:
+    """None when ip accepts a TCP connect on port within timeout, else the error."""
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout=timeout)
+    except (OSError, asyncio.TimeoutError) as e:
+        return e
+    writer.close()
+    return None
+
+
+def prescan_hosts(hosts: Iterable[Any], port: int, dead: HostRuns,
+                  timeout: float = PRESCAN_TIMEOUT, concurrency: int = PRESCAN_CONCURRENCY,
+                  on_dead: Optional[Callable[[str, int, BaseException], None]] = None) -> Iterator[Any]:
+    """Yield hosts that accept a non-blocking TCP connect on port (or their inventory port), in the order they answer.
+
+    Unanswered hosts are added to dead and passed to on_dead(ip, port, error)
+    from the scan thread. The scan runs at most concurrency connects
+    ahead of the consumer, so it overlaps with the SSH stage instead of preceding it.
+    """
+    budget = open_files_budget()
+    if budget is not None:
+        concurrency = min(concurrency, budget)
+
+    async def scan(put: Callable[[Any], Awaitable[None]]) -> None:
+        sem = asyncio.Semaphore(concurrency)
+        pending = set()
+
+        async def probe(target: Any) -> None:
+            ip, overrides = split_target(target)
+            target_port = overrides.get("port", port)
+            try:
+                error = await tcp_connect_error(ip, target_port, timeout)
+                if error is None:
+                    await put(target)
+                else:
+                    dead.add(ip)
+                    if on_dead:
+                        on_dead(ip, target_port, error)
+            finally:
+                sem.release()
+
+        for target in hosts:
+            await sem.acquire()
+            task = asyncio.ensure_future(probe(target))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        if pending:
+            await asyncio.gather(*pending)
+
+    return iter_async_producer(scan, "prescan", maxsize=concurrency)
+
+
+def iter_async_producer(produce: Callable[[Callable[[Any], Awaitable[None]]], Awaitable[None]],
+                        name: str, maxsize: int = 0) -> Iterator[Any]:
+    """Run produce(put) on a fresh event loop in a helper thread and yield every item it puts.
+
+    put() blocks (off-loop) while maxsize items are waiting, so a slow consumer
+    throttles the producer instead of letting the queue grow.
+    """
+    done = object()
+    items: "queue.Queue[Any]" = queue.Queue(maxsize=maxsize)
+    failure: List[BaseException] = []
+
+    async def put(item: Any) -> None:
+        await asyncio.get_running_loop().run_in_executor(None, items.put, item)
+
+    def loop_thread() -> None:
+        try:
+            asyncio.run(produce(put))
+        except BaseException as e:
+            failure.append(e)
+        finally:
+            items.put(done)
+
+    t = threading.Thread(target=loop_thread, name=name, daemon=True)
+    t.start()
+    while True:
+        item = items.get()
+        if item is done:
+            break
+        yield item
+    t.join()
+    if failure:
+        raise failure[0]
+
+
+# ---------------- persisted per-host state ----------------
+def host_port_key(ip: str, port: int) -> str:
+    """The key every per-host state file uses: inventory hosts may share an IP on different ports."""
+    return f"[{ip}]:{port}" if ":" in ip else f"{ip}:{port}"
+
+
+def _is_host_port_key(key: str) -> bool:
+    return key.rpartition(":")[2].isdigit() and (key.startswith("[") or key.count(":") == 1)
+
+
+class JsonState:
+    """{host_port_key: entry} state persisted as one JSON file (DeadHostCache, HostHistory, CapabilityCache).
+
+    A missing or unreadable file is empty state, and keys from files written
+    before entries were keyed by port are dropped. save() drops entries
+    expired() says are stale and writes through a temp file and os.replace()
+    only when something changed. Subclasses change entries under self.lock
+    and set self.dirty.
+    """
+
+    compact = False  # one line instead of indent=1 for files that get large
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.dirty = False
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                raw = json.load(f)
+            self.entries: Dict[str, Any] = {key: self.load_entry(entry) for key, entry in raw.items()
+                                            if _is_host_port_key(key)}
+            self.dirty = len(self.entries) != len(raw)
+        except (OSError, ValueError, TypeError, AttributeError):
+            self.entries = {}
+
+    def load_entry(self, entry: Any) -> Any:
+        """Hook to upgrade an entry from an older file format."""
+        return entry
+
+    def expired(self, entry: Any, now: float) -> bool:
+        return False
+
+    def save(self) -> None:
+        with self.lock:
+            now = time.time()
+            stale = [key for key, entry in self.entries.items() if self.expired(entry, now)]
+            for key in stale:
+                del self.entries[key]
+            if not (self.dirty or stale):
+                return
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                if self.compact:
+                    json.dump(self.entries, f, separators=(",", ":"), sort_keys=True)
+                else:
+                    json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+            self.dirty = False
+
+
+# ---------------- unreachable-host cache ----------------
+def unreachable_error(e: BaseException) -> bool:
+    """True for connect errors meaning nothing answered (timeouts, no route), not a refused port or bad login."""
+    if isinstance(e, (socket.timeout, asyncio.TimeoutError)):
+        return True
+    return isinstance(e, OSError) and e.errno in UNREACHABLE_ERRNOS
+
+
+class DeadHostCache(JsonState):
+    """Recent connect failures per IP and port with exponential-backoff penalty windows.
+
+    Only unreachable_error() failures of the TCP connect itself count, so a
+    wrong --port (refused everywhere) or a host stalling in the SSH
+    handshake does not land here. Each consecutive failure doubles the window (DEAD_TTL_BASE up to
+    DEAD_TTL_MAX); any answer from the host clears it. Entries whose window
+    ended more than DEAD_TTL_MAX ago are dropped on save, so a host that
+    comes back much later starts over.
+    """
+
+    def expired(self, entry: Dict[str, Any], now: float) -> bool:
+        return entry.get("until", 0) < now - DEAD_TTL_MAX
+
+    def penalized(self, ip: str, port: int, now: Optional[float] = None) -> bool:
+        entry = self.entries.get(host_port_key(ip, port))
+        return bool(entry) and entry.get("until", 0) > (time.time() if now is None else now)
+
+    def record_failure(self, ip: str, port: int, error: str) -> None:
+        now = time.time()
+        key = host_port_key(ip, port)
+        with self.lock:
+            entry = self.entries.get(key) or {"failures": 0}
+            entry["failures"] += 1
+            ttl = min(DEAD_TTL_BASE * 2 ** (entry["failures"] - 1), DEAD_TTL_MAX)
+            entry.update(until=now + ttl, last_error=error)
+            self.entries[key] = entry
+            self.dirty = True
+
+    def record_alive(self, ip: str, port: int) -> None:
+        with self.lock:
+            if self.entries.pop(host_port_key(ip, port), None) is not None:
+                self.dirty = True
+
+
+def skip_dead_hosts(hosts: Iterable[Any], cache: DeadHostCache, port: int, skipped: List[str],
+                    include_dead: bool = False) -> Iterator[Any]:
+    """Drop hosts inside their penalty window on port (or their inventory port), appending them
+    to skipped, or with include_dead defer them until every other host has been handed out."""
+    now = time.time()
+    deferred = []
+    for target in hosts:
+        ip, overrides = split_target(target)
+        if not cache.penalized(ip, overrides.get("port", port), now):
+            yield target
+        elif include_dead:
+            deferred.append(target)
+        else:
+            skipped.append(ip)
+    yield from deferred
+
+
+# ---------------- scheduling ----------------
+class HostHistory(JsonState):
+    """Expected run time per host and port (EWMA of past 'total' timings).
+
+    Entries are [seconds, last_seen]; hosts not seen for HISTORY_MAX_AGE are
+    dropped on save, so sweeping big ranges does not grow the file forever.
+    """
+
+    compact = True
+
+    def load_entry(self, entry: Any) -> List[float]:
+        return list(entry) if isinstance(entry, list) else [entry, round(time.time())]
+
+    def expired(self, entry: List[float], now: float) -> bool:
+        return entry[1] < now - HISTORY_MAX_AGE
+
+    def estimate(self, ip: str, port: int) -> Optional[float]:
+        entry = self.entries.get(host_port_key(ip, port))
+        return entry[0] if entry else None
+
+    def record(self, ip: str, port: int, seconds: float) -> None:
+        with self.lock:
+            old = self.estimate(ip, port)
+            new = seconds if old is None else old + HISTORY_EWMA_ALPHA * (seconds - old)
+            self.entries[host_port_key(ip, port)] = [round(new, 4), round(time.time())]
+            self.dirty = True
+
+
+def lpt_window(targets: List[Any], history: HostHistory, port: int) -> List[Any]:
+    """One window in longest-processing-time order: hosts with history longest first, unknown hosts
+    spread evenly between them (a window with no history is returned as is)."""
+    known: List[Tuple[float, Any]] = []
+    unknown: List[Any] = []
+    for target in targets:
+        ip, overrides = split_target(target)
+        estimate = history.estimate(ip, overrides.get("port", port))
+        if estimate is None:
+            unknown.append(target)
+        else:
+            known.append((estimate, target))
+    if not known:
+        return targets
+    known.sort(key=lambda item: item[0], reverse=True)
+
+    total, u = len(targets), len(unknown)
+    ordered: List[Any] = []
+    ki = ui = 0
+    for i in range(total):
+        # Take an unknown when the running share of unknowns falls half a slot behind u/total
+        if ui < u and (ki >= len(known) or (2 * ui + 1) * total <= 2 * (i + 1) * u):
+            ordered.append(unknown[ui])
+            ui += 1
+        else:
+            ordered.append(known[ki][1])
+            ki += 1
+    return ordered
+
+
+def lpt_order(hosts: Iterable[Any], history: HostHistory, port: int, window: int = LPT_WINDOW) -> Iterator[Any]:
+    """Longest-processing-time order over consecutive windows of hosts, still streamed lazily.
+
+    Submitting the slowest hosts first keeps them off the tail of the run;
+    interleaving the unknowns (rather than piling them at either end) hedges
+    against a cluster of slow new hosts. Sorting per window bounds memory to
+    window hosts however large the range, at the cost of a global order.
+    """
+    host_iter = iter(hosts)
+    while True:
+        chunk = list(itertools.islice(host_iter, window))
+        if not chunk:
+            return
+        yield from lpt_window(chunk, history, port)
 
 
 # ---------------- SSH helpers ----------------
-def run_ssh_command(client: paramiko.SSHClient, cmd: str) -> Tuple[int, str, str]:
-    stdin, stdout, stderr = client.exec_command(cmd)
-    out = stdout.read().decode("utf-8", errors="ignore")
-    err = stderr.read().decode("utf-8", errors="ignore")
-    exit_status = stdout.channel.recv_exit_status()
+class PhaseTimer:
+    """Monotonic (name, start, end) spans for the phases of one host's run."""
+
+    def __init__(self):
+        self.spans: List[Tuple[str, float, float]] = []
+        self.failed: Optional[str] = None  # the phase an exception first escaped from
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.monotonic()
+        try:
+            yield
+        except BaseException:
+            self.failed = self.failed or name
+            raise
+        finally:
+            self.spans.append((name, start, time.monotonic()))
+
+    def add(self, name: str, start: float, end: float) -> None:
+        self.spans.append((name, start, end))
+
+    def durations(self) -> Dict[str, float]:
+        out: Dict[str, float] = {}
+        for name, start, end in self.spans:
+            out[name] = round(out.get(name, 0.0) + (end - start), 4)
+        return out
+
+
+def open_transport(ip: str, port: int, username: str, password: str,
+                   timer: Optional[PhaseTimer] = None) -> paramiko.Transport:
+    """TCP connect, key exchange and password auth as separately timed steps."""
+    timer = timer or PhaseTimer()
+    with timer.phase("tcp_connect"):
+        sock = socket.create_connection((ip, port), timeout=SSH_CONNECT_TIMEOUT)
+    transport = paramiko.Transport(sock)
+    try:
+        with timer.phase("kex"):
+            # start_client(timeout=) just returns when the deadline passes; wait on the event instead
+            negotiated = threading.Event()
+            transport.start_client(event=negotiated)
+            if not negotiated.wait(SSH_CONNECT_TIMEOUT):
+                raise socket.timeout("SSH handshake timed out")
+            if not transport.is_active():
+                raise transport.get_exception() or paramiko.SSHException("SSH negotiation failed")
+        with timer.phase("auth"):
+            transport.auth_password(username, password)
+    except Exception:
+        transport.close()
+        raise
+    return transport
+
+
+def run_ssh_command_raw(transport: paramiko.Transport, cmd: str,
+                        stdin_data: Optional[bytes] = None) -> Tuple[int, bytes, bytes]:
+    chan = transport.open_session()
+    try:
+        chan.exec_command(cmd)
+        if stdin_data is not None:
+            chan.sendall(stdin_data)
+            chan.shutdown_write()
+        out = chan.makefile("rb").read()
+        err = chan.makefile_stderr("rb").read()
+        exit_status = chan.recv_exit_status()
+    finally:
+        chan.close()
     return exit_status, out, err
 
 
-def resolve_remote_path(client: paramiko.SSHClient, path: str) -> str:
-    if path.startswith("~"):
-        stdin, stdout, stderr = client.exec_command(f'echo {path}')
-        full_path = stdout.read().decode().strip()
-        return full_path
-    return path
+def run_ssh_command(transport: paramiko.Transport, cmd: str) -> Tuple[int, str, str]:
+    exit_status, out, err = run_ssh_command_raw(transport, cmd)
+    return exit_status, out.decode("utf-8", errors="ignore"), err.decode("utf-8", errors="ignore")
 
 
-def make_remote_backup(client: paramiko.SSHClient, config_path: str, backup_dir: str) -> Tuple[bool, str]:
-    cmd = f"""
+def backup_script(config_path: str, backup_dir: str) -> str:
+    return f"""
 set -e
 mkdir -p {backup_dir}
 cd {backup_dir}
@@ -127,159 +867,2703 @@ done
 
 cp {config_path} config.json.1 2>/dev/null || true
 """
-    es, out, err = run_ssh_command(client, cmd)
-    success = (es == 0)
-    msg = (out + err).strip()
-    return success, msg
 
 
-def remote_send_switchpool(client: paramiko.SSHClient) -> Tuple[bool, str]:
-    cmd = '(echo switchpool; sleep 1) | telnet localhost 4068 2>&1 || true'
-    es, out, err = run_ssh_command(client, cmd)
+def prepare_script(config_path_raw: str = CONFIG_PATH_RAW, backup_dir_raw: str = BACKUP_DIR_RAW) -> str:
+    """One exec that expands '~' and streams config.json back.
+
+    stdout is 'key=value' header lines followed by a PREPARE_MARKER line carrying
+    the config size in bytes and then the raw config bytes. Backups are rotated
+    later by commit_script(), and only when the config actually changes.
+    """
+    return f"""
+CONFIG_PATH={config_path_raw}
+BACKUP_DIR={backup_dir_raw}
+echo "config_path=$CONFIG_PATH"
+echo "backup_dir=$BACKUP_DIR"
+echo "hostname=$(uname -n 2>/dev/null)"
+
+if [ ! -r "$CONFIG_PATH" ]; then
+    echo "read=cannot read $CONFIG_PATH"
+    exit 1
+fi
+echo "{PREPARE_MARKER} $(wc -c < "$CONFIG_PATH")"
+cat "$CONFIG_PATH"
+"""
+
+
+def parse_prepare_output(es: int, out: bytes, err: bytes) -> Dict[str, Any]:
+    """Split prepare_script() output into header fields plus 'data' (config text) or 'error'."""
+    head, marker, body = out.partition(PREPARE_MARKER.encode() + b" ")
+    info: Dict[str, Any] = {}
+    for line in head.decode("utf-8", errors="ignore").splitlines():
+        key, sep, value = line.partition("=")
+        if sep:
+            info[key.strip()] = value.strip()
+
+    err_text = err.decode("utf-8", errors="ignore").strip()
+    if not marker:
+        info["error"] = ("read config failed", info.get("read") or err_text or f"exit_status={es}")
+        return info
+
+    size_str, _, data = body.partition(b"\n")
+    size = int(size_str.strip() or 0)
+    if len(data) != size:
+        info["error"] = ("read config failed", f"truncated read ({len(data)} of {size} bytes)")
+        return info
+    info["data"] = data.decode("utf-8")
+    return info
+
+
+def remote_prepare(transport: paramiko.Transport) -> Dict[str, Any]:
+    es, out, err = run_ssh_command_raw(transport, prepare_script())
+    return parse_prepare_output(es, out, err)
+
+
+def pools_hash(pools: Any) -> str:
+    """sha256 of the canonical JSON form of a pools list (sorted keys, compact, UTF-8)."""
+    canonical = json.dumps(pools, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+# Remote twin of pools_hash(); must produce the same canonical bytes
+POOLS_HASH_PY = (
+    "import hashlib,json,sys\n"
+    "p=json.load(open(sys.argv[1])).get('pools')\n"
+    "s=json.dumps(p,sort_keys=True,separators=(',',':'),ensure_ascii=False)\n"
+    "print(hashlib.sha256(s.encode('utf-8')).hexdigest())\n"
+)
+
+
+def drift_script(config_path_raw: str = CONFIG_PATH_RAW, backup_dir_raw: str = BACKUP_DIR_RAW) -> str:
+    """One exec that hashes the remote pools array without shipping config.json back.
+
+    Tries python3/python and prints 'pools_sha256=<hex>'. Without python it falls
+    back to prepare_script()'s framed cat and the hash is computed locally; jq is
+    not used, as 'jq -cS' spells numbers like 1.0 or 60e0 and some escapes
+    differently from pools_hash(), which would report such hosts drifted forever.
+    """
+    return f"""
+CONFIG_PATH={config_path_raw}
+BACKUP_DIR={backup_dir_raw}
+echo "config_path=$CONFIG_PATH"
+echo "backup_dir=$BACKUP_DIR"
+echo "hostname=$(uname -n 2>/dev/null)"
+
+if [ ! -r "$CONFIG_PATH" ]; then
+    echo "read=cannot read $CONFIG_PATH"
+    exit 1
+fi
+for PY in python3 python; do
+    if command -v "$PY" >/dev/null 2>&1; then
+        H=$("$PY" -c {shlex.quote(POOLS_HASH_PY)} "$CONFIG_PATH" 2>/dev/null)
+        if [ $? -eq 0 ] && [ -n "$H" ]; then
+            echo "hashed_by=$PY"
+            echo "pools_sha256=$H"
+            exit 0
+        fi
+    fi
+done
+echo "{PREPARE_MARKER} $(wc -c < "$CONFIG_PATH")"
+cat "$CONFIG_PATH"
+"""
+
+
+def parse_drift_output(es: int, out: bytes, err: bytes) -> Dict[str, Any]:
+    """Like parse_prepare_output(), plus 'pools_sha256' (hashed locally when the remote sent the config)."""
+    info = parse_prepare_output(es, out, err)
+    if info.get("pools_sha256"):
+        info.pop("error", None)
+    elif "data" in info:
+        try:
+            info["pools_sha256"] = pools_hash(json.loads(info["data"]).get("pools"))
+            info["hashed_by"] = "local"
+        except Exception as e:
+            info["error"] = ("json parse failed", f"{type(e).__name__}: {e}")
+    return info
+
+
+def remote_drift_check(transport: paramiko.Transport) -> Dict[str, Any]:
+    es, out, err = run_ssh_command_raw(transport, drift_script())
+    return parse_drift_output(es, out, err)
+
+
+COMMIT_BACKUP_FAILED = 3  # commit_script() exit status when the backup rotation fails
+PATCH_UNSUPPORTED = 4  # patch_script(): no dd or cksum on the host, caller falls back to a full write
+PATCH_CONFIG_CHANGED = 5  # patch_script(): config.json no longer matches the bytes that were read
+
+
+def commit_script(config_path: str, backup_dir: str) -> str:
+    """One exec that rotates backups and then overwrites config.json with stdin."""
+    return f"""
+CONFIG_PATH={shlex.quote(config_path)}
+BACKUP_DIR={shlex.quote(backup_dir)}
+({backup_script('"$CONFIG_PATH"', '"$BACKUP_DIR"')})
+# Checked separately: 'set -e' inside the subshell is ignored when it is the left side of '||'
+[ $? -eq 0 ] || exit {COMMIT_BACKUP_FAILED}
+cat > "$CONFIG_PATH"
+"""
+
+
+def inplace_edits(old_data: bytes, new_data: bytes) -> Optional[List[Tuple[int, bytes]]]:
+    """(offset, bytes) runs turning old_data into new_data without moving anything.
+
+    Only for same-length rewrites made of a few printable ASCII runs (the
+    typical '"disabled": 0' -> 1 flip); None means write the whole file.
+    """
+    if len(old_data) != len(new_data):
+        return None
+    edits: List[Tuple[int, bytes]] = []
+    i, n = 0, len(old_data)
+    while i < n:
+        if old_data[i] == new_data[i]:
+            i += 1
+            continue
+        j = i
+        while j < n and old_data[j] != new_data[j]:
+            j += 1
+        run = new_data[i:j]
+        if len(edits) == INPLACE_PATCH_MAX_RUNS or not all(0x20 <= b < 0x7f for b in run):
+            return None
+        edits.append((i, run))
+        i = j
+    return edits
+
+
+def _cksum_table() -> List[int]:
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7 if crc & 0x80000000 else crc << 1) & 0xFFFFFFFF
+        table.append(crc)
+    return table
+
+
+_CKSUM_TABLE = _cksum_table()
+
+
+def posix_cksum(data: bytes) -> int:
+    """The CRC printed by POSIX 'cksum' (CRC-32/CKSUM, length appended), which even busybox hosts have."""
+    crc = 0
+    for b in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ _CKSUM_TABLE[(crc >> 24) ^ b]
+    n = len(data)
+    while n:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ _CKSUM_TABLE[(crc >> 24) ^ (n & 0xFF)]
+        n >>= 8
+    return crc ^ 0xFFFFFFFF
+
+
+def patch_script(config_path: str, backup_dir: str, edits: List[Tuple[int, bytes]], old_data: bytes) -> str:
+    """One exec that rotates backups and overwrites only the changed byte runs of config.json with dd.
+
+    The file must still cksum to old_data (the bytes the edits were computed
+    from); a config rewritten in between, even to the same size, is left alone.
+    """
+    writes = "\n".join(
+        f"printf '%s' {shlex.quote(run.decode('ascii'))} | dd of=\"$CONFIG_PATH\" bs=1 seek={offset} conv=notrunc 2>/dev/null || exit 1"
+        for offset, run in edits)
+    return f"""
+CONFIG_PATH={shlex.quote(config_path)}
+BACKUP_DIR={shlex.quote(backup_dir)}
+command -v dd >/dev/null 2>&1 && command -v cksum >/dev/null 2>&1 || exit {PATCH_UNSUPPORTED}
+set -- $(cksum < "$CONFIG_PATH")
+if [ "$1" != {posix_cksum(old_data)} ] || [ "$2" != {len(old_data)} ]; then
+    echo "config.json changed since it was read"
+    exit {PATCH_CONFIG_CHANGED}
+fi
+({backup_script('"$CONFIG_PATH"', '"$BACKUP_DIR"')})
+[ $? -eq 0 ] || exit {COMMIT_BACKUP_FAILED}
+{writes}
+"""
+
+
+def commit_error(es: int, out: bytes, err: bytes) -> Optional[Tuple[str, str]]:
+    """(stage, detail) for a failed commit_script()/patch_script() run, None on success."""
+    if es == 0:
+        return None
+    detail = (out + err).decode("utf-8", errors="ignore").strip() or f"exit_status={es}"
+    return ("backup failed" if es == COMMIT_BACKUP_FAILED else "write config failed"), detail
+
+
+def remote_commit(transport: paramiko.Transport, config_path: str, backup_dir: str,
+                  new_data: bytes, old_data: Optional[bytes] = None) -> Optional[Tuple[str, str]]:
+    """Write new_data over config.json; given old_data, try patching just the changed bytes in place first."""
+    edits = inplace_edits(old_data, new_data) if old_data is not None else None
+    if edits:
+        es, out, err = run_ssh_command_raw(transport, patch_script(config_path, backup_dir, edits, old_data))
+        if es != PATCH_UNSUPPORTED:
+            return commit_error(es, out, err)
+    es, out, err = run_ssh_command_raw(transport, commit_script(config_path, backup_dir), stdin_data=new_data)
+    return commit_error(es, out, err)
+
+
+EDIT_UNSUPPORTED = 4  # remote_edit_script(): neither python nor jq on the host
+
+# Remote twin of ConfigOps.apply(); writes the new config to argv[2] only when the ops change it
+REMOTE_EDIT_PY = r"""
+import json, re, sys
+path, tmp, ops = sys.argv[1], sys.argv[2], json.loads(sys.argv[3])
+ALIASES = %s
+
+def normalize(url):  # normalize_url()
+    scheme, sep, rest = url.strip().partition("://")
+    if not sep:
+        scheme, rest = %r, url.strip()
+    scheme = ALIASES.get(scheme.lower(), scheme.lower())
+    host, slash, path = rest.partition("/")
+    return (scheme + "://" + host.lower() + slash + path).rstrip("/")
+
+def host_of(norm):  # url_host()
+    hostport = norm.partition("://")[2].partition("/")[0]
+    host, sep, port = hostport.rpartition(":")
+    return host if sep and port.isdigit() else hostport
+
+def matcher(spec):  # UrlMatcher.__contains__()
+    urls, norm_urls, hosts = set(spec["urls"]), set(spec["norm"]), set(spec["hosts"])
+    patterns = [re.compile(p, re.IGNORECASE) for p in spec["patterns"]]
+    def match(url):
+        if not hasattr(url, "lower"):
+            return False
+        if url in urls:
+            return True
+        norm = normalize(url)
+        return norm in norm_urls or host_of(norm) in hosts or any(p.search(norm) for p in patterns)
+    return match
+
+def index(container, token, path, allow_end=False):  # _pointer_index()
+    if token == "-" and allow_end:
+        return len(container)
+    if not token.isdigit() or (len(token) > 1 and token[0] == "0"):
+        sys.exit("bad array index " + repr(token) + " in " + path)
+    i = int(token)
+    if i > len(container) or (i == len(container) and not allow_end):
+        sys.exit("index " + str(i) + " out of range in " + path)
+    return i
+
+def apply(doc, kind, path, value):  # apply_patch_op()
+    tokens = [t.replace("~1", "/").replace("~0", "~") for t in path[1:].split("/")]
+    try:
+        parent = doc
+        for t in tokens[:-1]:
+            parent = parent[index(parent, t, path) if isinstance(parent, list) else t]
+        last = tokens[-1]
+        if isinstance(parent, list):
+            last = index(parent, last, path, allow_end=(kind == "add"))
+            if kind == "add":
+                parent.insert(last, value)
+                return
+        if kind == "add":
+            parent[last] = value
+        elif kind == "replace":
+            parent[last]
+            parent[last] = value
+        elif kind == "remove":
+            del parent[last]
+        elif parent[last] != value:
+            sys.exit("test failed at " + path)
+    except (KeyError, IndexError, ValueError, TypeError):
+        sys.exit(kind + ": no such path " + path)
+
+with open(path) as f:
+    config = json.load(f)
+before = json.loads(json.dumps(config))
+for op in ops:
+    if op["op"] in ("enable-pools", "disable-pools"):
+        match, want = matcher(op["match"]), int(op["op"] == "disable-pools")
+        pools = config.get("pools") if isinstance(config, dict) else None
+        for p in pools if isinstance(pools, list) else []:
+            if match(p.get("url")) and p.get("disabled") != want:
+                p["disabled"] = want
+    else:
+        apply(config, op["op"], op["path"], op.get("value"))
+if config != before:
+    with open(tmp, "w") as f:
+        f.write(json.dumps(config, indent=4))
+""" % (json.dumps(URL_SCHEME_ALIASES), DEFAULT_URL_SCHEME)
+
+# jq fallback for ConfigOps.jq_args ops: prints nothing when the pools would not change; $d/$e are {url: true} objects
+REMOTE_EDIT_JQ = """
+.pools as $before
+| if $p != null then .pools = $p
+  else .pools = ((.pools // []) | map(
+    (.url | if type == "string" then . else "" end) as $url
+    | if $d[$url] then (if (.disabled | . == 1 or . == true) then . else .disabled = 1 end)
+      elif $e[$url] then (if (.disabled | . == 0 or . == false) then . else .disabled = 0 end)
+      else . end))
+  end
+| if .pools == $before then empty else . end
+"""
+
+
+def remote_edit_script(ops: "ConfigOps",
+                       config_path_raw: str = CONFIG_PATH_RAW, backup_dir_raw: str = BACKUP_DIR_RAW) -> str:
+    """One exec that applies the ops on the host: edit to a temp file, rotate backups, rename over config.json.
+
+    Uses python3/python, else jq (pool ops with exact URLs or a lone pools
+    replacement only); exits EDIT_UNSUPPORTED when neither applies so the
+    caller can fall back to remote_prepare() + remote_commit().
+    """
+    jq_args = ops.jq_args
+    jq_ok = jq_args is not None
+    disable, enable, new_pools = jq_args or ({}, {}, None)
+    disable_obj, enable_obj = json.dumps(disable), json.dumps(enable)
+    op = json.dumps(ops.remote_spec())
+    return f"""
+CONFIG_PATH={config_path_raw}
+BACKUP_DIR={backup_dir_raw}
+TMP="$CONFIG_PATH.edit.$$"
+if command -v python3 >/dev/null 2>&1; then BY=python3
+elif command -v python >/dev/null 2>&1; then BY=python
+elif {"true" if jq_ok else "false"} && command -v jq >/dev/null 2>&1; then BY=jq
+else exit {EDIT_UNSUPPORTED}
+fi
+echo "edited_by=$BY"
+if [ "$BY" = jq ]; then
+    jq --indent 4 --argjson d {shlex.quote(disable_obj)} --argjson e {shlex.quote(enable_obj)} \
+        --argjson p {shlex.quote(json.dumps(new_pools))} {shlex.quote(REMOTE_EDIT_JQ)} "$CONFIG_PATH" > "$TMP"
+else
+    "$BY" -c {shlex.quote(REMOTE_EDIT_PY)} "$CONFIG_PATH" "$TMP" {shlex.quote(op)}
+fi
+if [ $? -ne 0 ]; then
+    rm -f "$TMP"
+    exit 1
+fi
+if [ ! -s "$TMP" ]; then
+    rm -f "$TMP"
+    echo "edit=unchanged"
+    exit 0
+fi
+({backup_script('"$CONFIG_PATH"', '"$BACKUP_DIR"')})
+if [ $? -ne 0 ]; then
+    rm -f "$TMP"
+    exit {COMMIT_BACKUP_FAILED}
+fi
+mv -f "$TMP" "$CONFIG_PATH" || exit 1
+echo "edit=updated"
+"""
+
+
+def parse_edit_output(es: int, out: bytes, err: bytes) -> Dict[str, Any]:
+    """'edit' is 'updated', 'unchanged' or 'unsupported'; failures carry 'error' as (stage, detail)."""
+    if es == EDIT_UNSUPPORTED:
+        return {"edit": "unsupported"}
+    info: Dict[str, Any] = {}
+    for line in out.decode("utf-8", errors="ignore").splitlines():
+        key, sep, value = line.partition("=")
+        if sep:
+            info[key.strip()] = value.strip()
+    if es != 0 or info.get("edit") not in ("updated", "unchanged"):
+        lines = err.decode("utf-8", errors="ignore").strip().splitlines()
+        detail = lines[-1] if lines else f"exit_status={es}"
+        info["error"] = ("backup failed" if es == COMMIT_BACKUP_FAILED else "remote edit failed", detail)
+    return info
+
+
+def remote_edit(transport: paramiko.Transport, ops: "ConfigOps") -> Dict[str, Any]:
+    es, out, err = run_ssh_command_raw(transport, remote_edit_script(ops))
+    return parse_edit_output(es, out, err)
+
+
+def remote_send_switchpool_telnet(transport: paramiko.Transport, cmd: str = SWITCHPOOL_TELNET_CMD) -> Tuple[bool, str]:
+    es, out, err = run_ssh_command(transport, cmd)
     combined = (out + err).lower()
     if "ok|" in combined:
         return True, "switchpool ok"
     return False, combined.strip() or f"exit_status={es}"
 
 
+def api_command_via_tunnel(transport: paramiko.Transport, command: str, timeout: float) -> str:
+    """Send one ccminer API command over a direct-tcpip channel and return the reply.
+
+    Returns as soon as the reply terminator '|' arrives (or the API closes the
+    socket); raises socket.timeout if nothing complete arrives within timeout.
+    """
+    chan = transport.open_channel(
+        "direct-tcpip", (CCMINER_API_HOST, CCMINER_API_PORT), ("127.0.0.1", 0), timeout=timeout)
+    try:
+        deadline = time.monotonic() + timeout
+        chan.sendall(command.encode())
+        reply = b""
+        while b"|" not in reply:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout(f"no API reply within {timeout}s")
+            chan.settimeout(remaining)
+            chunk = chan.recv(4096)
+            if not chunk:
+                break
+            reply += chunk
+        return reply.decode("utf-8", errors="ignore")
+    finally:
+        chan.close()
+
+
+def remote_send_switchpool(transport: paramiko.Transport, method: str = "auto",
+                           timeout: float = SWITCHPOOL_TIMEOUT) -> Tuple[bool, str]:
+    """Trigger switchpool via the SSH tunnel ('tunnel'), telnet ('telnet'), nc ('nc'), or tunnel then telnet ('auto').
+    'none' (from pick_switch_method) reports that the host has no way to reach the API."""
+    if method == "none":
+        return False, "no way to reach the ccminer API (no TCP forwarding, telnet or nc)"
+    if method == "nc":
+        return remote_send_switchpool_telnet(transport, SWITCHPOOL_NC_CMD)
+    if method in ("auto", "tunnel"):
+        try:
+            reply = api_command_via_tunnel(transport, "switchpool", timeout)
+        except (paramiko.SSHException, EOFError) as e:
+            # Channel could not be opened (e.g. AllowTcpForwarding no)
+            if method == "tunnel":
+                return False, f"tunnel failed: {type(e).__name__}: {e}"
+        except socket.timeout as e:
+            return False, f"tunnel timeout: {e}"
+        else:
+            if "ok|" in reply.lower():
+                return True, "switchpool ok"
+            return False, reply.strip() or "empty API reply"
+    return remote_send_switchpool_telnet(transport)
+
+
+# ---------------- capability probe ----------------
+def probe_script() -> str:
+    """One exec that reports which PROBE_TOOLS exist, as 'tool=1' / 'tool=0' lines."""
+    return f"""
+for TOOL in {' '.join(PROBE_TOOLS)}; do
+    if command -v "$TOOL" >/dev/null 2>&1; then echo "$TOOL=1"; else echo "$TOOL=0"; fi
+done
+"""
+
+
+def parse_probe_output(out: str) -> Dict[str, bool]:
+    found = {}
+    for line in out.splitlines():
+        tool, sep, value = line.partition("=")
+        if sep:
+            found[tool.strip()] = value.strip() == "1"
+    caps = {tool: found.get(tool, False) for tool in PROBE_TOOLS if not tool.startswith("python")}
+    caps["python"] = found.get("python3", False) or found.get("python", False)
+    return caps
+
+
+def host_key_fingerprint(key_blob: bytes) -> str:
+    """sha256 of the SSH wire-format host key, the same for paramiko and asyncssh."""
+    return hashlib.sha256(key_blob).hexdigest()
+
+
+def pick_switch_method(method: str, caps: Optional[Dict[str, Any]]) -> str:
+    """Resolve 'auto' to the fastest mechanism the host supports; unchanged without probe data."""
+    if method != "auto" or caps is None:
+        return method
+    if caps.get("forwarding"):
+        return "tunnel"
+    if caps.get("forwarding") is None:
+        return "auto"  # forwarding unknown: keep trying the tunnel first
+    if caps.get("telnet"):
+        return "telnet"
+    if caps.get("nc"):
+        return "nc"
+    return "none"
+
+
+def probe_forwarding(transport: paramiko.Transport, timeout: float) -> Optional[bool]:
+    """True if a channel to the API opens, False if sshd prohibits it, None if that can't be told apart
+    (e.g. ccminer not listening)."""
+    try:
+        chan = transport.open_channel(
+            "direct-tcpip", (CCMINER_API_HOST, CCMINER_API_PORT), ("127.0.0.1", 0), timeout=timeout)
+    except paramiko.ChannelException as e:
+        return False if e.code == paramiko.common.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED else None
+    except (paramiko.SSHException, EOFError):
+        return None
+    chan.close()
+    return True
+
+
+def remote_probe(transport: paramiko.Transport, timeout: float = SWITCHPOOL_TIMEOUT) -> Dict[str, Any]:
+    es, out, err = run_ssh_command(transport, probe_script())
+    if es != 0:
+        raise IOError(err.strip() or f"probe exit_status={es}")
+    caps = parse_probe_output(out)
+    caps["forwarding"] = probe_forwarding(transport, timeout)
+    return caps
+
+
+class CapabilityCache(JsonState):
+    """Probed capabilities per host and port, valid only while the host key fingerprint matches and for ttl seconds.
+
+    Matching on the fingerprint means a replaced or re-flashed device at a
+    known address gets probed again.
+    """
+
+    def __init__(self, path: str, ttl: float = PROBE_TTL):
+        super().__init__(path)
+        self.ttl = ttl
+
+    def get(self, ip: str, port: int, fingerprint: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            entry = self.entries.get(host_port_key(ip, port))
+        if entry and entry.get("fingerprint") == fingerprint and time.time() - entry.get("probed_at", 0) < self.ttl:
+            return entry["caps"]
+        return None
+
+    def put(self, ip: str, port: int, fingerprint: str, caps: Dict[str, Any]) -> None:
+        with self.lock:
+            self.entries[host_port_key(ip, port)] = {"fingerprint": fingerprint, "probed_at": time.time(), "caps": caps}
+            self.dirty = True
+
+    def invalidate(self, ip: str, port: int) -> None:
+        with self.lock:
+            if self.entries.pop(host_port_key(ip, port), None) is not None:
+                self.dirty = True
+
+
+_capability_caches: Dict[str, CapabilityCache] = {}
+_capability_caches_lock = threading.Lock()
+
+
+def capability_cache(path: str, ttl: float = PROBE_TTL) -> CapabilityCache:
+    """Process-wide CapabilityCache for path, so worker threads and daemon jobs share one copy."""
+    with _capability_caches_lock:
+        cache = _capability_caches.get(path)
+        if cache is None:
+            cache = _capability_caches[path] = CapabilityCache(path, ttl)
+        cache.ttl = ttl
+        return cache
+
+
+def save_capability_caches() -> None:
+    with _capability_caches_lock:
+        caches = list(_capability_caches.values())
+    for cache in caches:
+        try:
+            cache.save()
+        except OSError as e:
+            print(f"Cannot write capability cache {cache.path}: {e}", file=sys.stderr)
+
+
 # ---------------- config update logic ----------------
+def new_result(ip: str, msg: str = "") -> Dict[str, Any]:
+    return {"ip": ip, "success": False, "updated": False, "unchanged": False, "switched": False, "msg": msg}
+
+
+def normalize_url(url: str) -> str:
+    """Canonical pool URL for selectors: scheme and host lower-cased, 'stratum' -> 'stratum+tcp',
+    missing scheme -> 'stratum+tcp', no trailing slashes."""
+    scheme, sep, rest = url.strip().partition("://")
+    if not sep:
+        scheme, rest = DEFAULT_URL_SCHEME, url.strip()
+    scheme = URL_SCHEME_ALIASES.get(scheme.lower(), scheme.lower())
+    host, slash, path = rest.partition("/")
+    return f"{scheme}://{host.lower()}{slash}{path}".rstrip("/")
+
+
+def url_host(normalized: str) -> str:
+    """Host part of a normalize_url() result, without the port."""
+    hostport = normalized.partition("://")[2].partition("/")[0]
+    host, sep, port = hostport.rpartition(":")
+    return host if sep and port.isdigit() else hostport
+
+
+def glob_regex(glob: str) -> str:
+    """Shell-style glob -> anchored regex like fnmatch.translate(), in syntax every Python 3 re accepts
+    (3.11+ translate() emits atomic groups, which older hosts reject)."""
+    out: List[str] = []
+    i, n = 0, len(glob)
+    while i < n:
+        c = glob[i]
+        i += 1
+        if c == "*":
+            if not out or out[-1] != ".*":  # '**' is one star; runs of '.*' backtrack badly
+                out.append(".*")
+        elif c == "?":
+            out.append(".")
+        elif c == "[":
+            j = i + (i < n and glob[i] == "!")
+            j += j < n and glob[j] == "]"
+            j = glob.find("]", j)
+            if j < 0:
+                out.append(r"\[")
+                continue
+            body, i = glob[i:j], j + 1
+            negate = body.startswith("!")
+            if negate:
+                body = body[1:]
+            items, k = [], 0
+            while k < len(body):
+                if k + 2 < len(body) and body[k + 1] == "-":
+                    if body[k] <= body[k + 2]:  # a reversed range matches nothing, as in fnmatch
+                        items.append(f"{re.escape(body[k])}-{re.escape(body[k + 2])}")
+                    k += 3
+                else:
+                    items.append(re.escape(body[k]))
+                    k += 1
+            if items:
+                out.append(("[^" if negate else "[") + "".join(items) + "]")
+            else:
+                out.append("." if negate else "(?!)")
+        else:
+            out.append(re.escape(c))
+    return r"(?s)\A" + "".join(out) + r"\Z"
+
+
+class UrlMatcher:
+    """Pool URL selector compiled once per run; 'url in matcher' is what update_pools_list() asks.
+
+    Plain URLs (--disable-url/--enable-url) match exactly. Selectors
+    (--disable-match/--enable-match) are normalized first (see normalize_url)
+    and are one of:
+      host:<name>   any URL on that host, whatever the scheme or port
+      re:<regex>    regex searched in the normalized URL (case-insensitive)
+      <glob>        shell-style pattern, e.g. 'stratum+tcp://*.vipor.net:*'
+      <url>         the URL itself, compared after normalization
+    Each glob and regex is compiled on its own, so a regex may carry inline
+    flags like '(?i)'. Globs go through glob_regex() rather than
+    fnmatch.translate(), whose output on newer Pythons does not compile on
+    the older Pythons REMOTE_EDIT_PY may run under.
+    """
+
+    def __init__(self, urls: Iterable[str] = (), selectors: Iterable[str] = ()):
+        self.urls = frozenset(urls)
+        self.selectors = tuple(sorted(set(selectors)))
+        norm_urls, hosts, patterns = set(), set(), []
+        for selector in self.selectors:
+            if selector.startswith("host:"):
+                hosts.add(selector[len("host:"):].strip().lower())
+            elif selector.startswith("re:"):
+                patterns.append(selector[len("re:"):])
+            elif any(c in selector for c in "*?["):
+                patterns.append(glob_regex(normalize_url(selector)))
+            else:
+                norm_urls.add(normalize_url(selector))
+        self.norm_urls = frozenset(norm_urls)
+        self.hosts = frozenset(hosts)
+        self.patterns = tuple(re.compile(pattern, re.IGNORECASE) for pattern in patterns)
+        self.memo: Dict[str, bool] = {}
+
+    @property
+    def exact_only(self) -> bool:
+        return not (self.norm_urls or self.hosts or self.patterns)
+
+    def __contains__(self, url: Any) -> bool:
+        if not isinstance(url, str):
+            return False
+        if url in self.urls:
+            return True
+        if self.exact_only:
+            return False
+        hit = self.memo.get(url)
+        if hit is None:
+            norm = normalize_url(url)
+            hit = (norm in self.norm_urls or url_host(norm) in self.hosts
+                   or any(pattern.search(norm) for pattern in self.patterns))
+            if len(self.memo) < URL_MATCH_MEMO_SIZE:
+                self.memo[url] = hit
+        return hit
+
+    def __bool__(self) -> bool:
+        return bool(self.urls or self.selectors)
+
+    def __eq__(self, other: Any) -> bool:
+        return isinstance(other, UrlMatcher) and (self.urls, self.selectors) == (other.urls, other.selectors)
+
+    def __hash__(self) -> int:
+        return hash((self.urls, self.selectors))
+
+    def __repr__(self) -> str:
+        return f"UrlMatcher({sorted(self.urls)!r}, {list(self.selectors)!r})"
+
+    def spec(self) -> Dict[str, List[str]]:
+        """JSON form for the daemon header; url_matcher() turns it back into a UrlMatcher."""
+        return {"urls": sorted(self.urls), "selectors": list(self.selectors)}
+
+    def remote_spec(self) -> Dict[str, Any]:
+        """Compiled form for REMOTE_EDIT_PY."""
+        return {"urls": sorted(self.urls), "norm": sorted(self.norm_urls), "hosts": sorted(self.hosts),
+                "patterns": [pattern.pattern for pattern in self.patterns]}
+
+
+def url_matcher(urls: Any) -> UrlMatcher:
+    """UrlMatcher from one URL, an iterable of URLs, a spec() dict or None (a UrlMatcher is returned as is)."""
+    if isinstance(urls, UrlMatcher):
+        return urls
+    if urls is None:
+        return UrlMatcher()
+    if isinstance(urls, str):
+        return UrlMatcher([urls])
+    if isinstance(urls, dict):
+        return UrlMatcher(urls.get("urls", ()), urls.get("selectors", ()))
+    return UrlMatcher(urls)
+
+
 def update_pools_list(existing_pools: List[Dict[str, Any]],
-                      disable_url: Optional[str] = None,
-                      enable_url: Optional[str] = None,
+                      disable_urls: Optional[Iterable[str]] = None,
+                      enable_urls: Optional[Iterable[str]] = None,
                       new_pools: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
     if new_pools is not None:
         return new_pools
 
+    disable_urls = url_matcher(disable_urls)
+    enable_urls = url_matcher(enable_urls)
     for p in existing_pools:
-        if disable_url and p.get("url") == disable_url:
+        url = p.get("url")
+        if url in disable_urls:
             if p.get("disabled") != 1:
                 p["disabled"] = 1
-        elif enable_url and p.get("url") == enable_url:
+        elif url in enable_urls:
             if p.get("disabled") != 0:
                 p["disabled"] = 0
 
     return existing_pools
 
 
-def process_host(ip: str, username: str, password: str, port: int,
-                 disable_url: Optional[str], enable_url: Optional[str],
-                 new_pools: Optional[List[Dict[str, Any]]],
-                 do_switchpool: bool) -> Dict[str, Any]:
+POOL_OPS = ("enable-pools", "disable-pools")  # ConfigOps extensions behind the URL flags
+PATCH_OPS = ("add", "replace", "remove", "test")
 
-    result = {"ip": ip, "success": False, "updated": False, "switched": False, "msg": ""}
 
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    try:
-        client.connect(ip, port=port, username=username, password=password, timeout=SSH_CONNECT_TIMEOUT)
-    except Exception as e:
-        result["msg"] = f"SSH connect failed: {type(e).__name__}: {e}"
-        return result
+class PatchError(ValueError):
+    """An op could not be applied to a host's config (missing path, failed test)."""
 
-    sftp = None
+
+def parse_json_pointer(path: str) -> List[str]:
+    """RFC 6901 pointer -> reference tokens, e.g. '/pools/0/url' -> ['pools', '0', 'url']."""
+    if not path.startswith("/"):
+        raise ValueError(f"JSON pointer must start with '/': {path!r}")
+    return [token.replace("~1", "/").replace("~0", "~") for token in path[1:].split("/")]
+
+
+def _pointer_index(container: List[Any], token: str, path: str, allow_end: bool = False) -> int:
+    if token == "-" and allow_end:
+        return len(container)
+    if not token.isdigit() or (len(token) > 1 and token[0] == "0"):
+        raise PatchError(f"bad array index {token!r} in {path}")
+    index = int(token)
+    if index > len(container) or (index == len(container) and not allow_end):
+        raise PatchError(f"index {index} out of range in {path}")
+    return index
+
+
+def apply_patch_op(doc: Any, kind: str, path: str, tokens: List[str], value: Any) -> None:
+    """Apply one add/replace/remove/test op to doc in place; raises PatchError like RFC 6902 would fail."""
+    parent = doc
+    for token in tokens[:-1]:
+        if isinstance(parent, dict) and token in parent:
+            parent = parent[token]
+        elif isinstance(parent, list):
+            parent = parent[_pointer_index(parent, token, path)]
+        else:
+            raise PatchError(f"{kind}: no such path {path}")
+    last = tokens[-1]
+
+    if isinstance(parent, dict):
+        if kind == "add":
+            parent[last] = copy.deepcopy(value)
+            return
+        if last not in parent:
+            raise PatchError(f"{kind}: no such path {path}")
+        if kind == "replace":
+            parent[last] = copy.deepcopy(value)
+        elif kind == "remove":
+            del parent[last]
+        elif parent[last] != value:
+            raise PatchError(f"test failed at {path}")
+    elif isinstance(parent, list):
+        index = _pointer_index(parent, last, path, allow_end=(kind == "add"))
+        if kind == "add":
+            parent.insert(index, copy.deepcopy(value))
+        elif kind == "replace":
+            parent[index] = copy.deepcopy(value)
+        elif kind == "remove":
+            del parent[index]
+        elif parent[index] != value:
+            raise PatchError(f"test failed at {path}")
+    else:
+        raise PatchError(f"{kind}: no such path {path}")
+
+
+TEMPLATE_VARS = ("ip", "ip_dashed", "ip_last", "hostname", "region")
+_TEMPLATE_RE = re.compile(r"(\$?)\$\{([A-Za-z_][A-Za-z0-9_]*)\}")  # '$${name}' is an escaped literal '${name}'
+
+
+class ValueTemplate:
+    """A JSON value whose strings may hold ${var} placeholders (TEMPLATE_VARS), compiled once.
+
+    Other ${...} text is left as is, so existing values that happen to contain
+    it keep working; '$${var}' writes a literal '${var}'.
+
+    Each templated string is split into literal and variable parts up front,
+    and untemplated subtrees are returned as is, so render() is a plain walk
+    with string joins.
+    """
+
+    def __init__(self, value: Any):
+        self.names: Set[str] = set()
+        self.render_value = self._compile(value)
+
+    def _compile(self, value: Any) -> Callable[[Dict[str, Optional[str]]], Any]:
+        if isinstance(value, str):
+            parts = [""]  # literal, name, literal, name, ..., literal
+            end = 0
+            for m in _TEMPLATE_RE.finditer(value):
+                escaped, name = m.group(1), m.group(2)
+                parts[-1] += value[end:m.start()]
+                if escaped or name not in TEMPLATE_VARS:
+                    parts[-1] += m.group(0)[len(escaped):]
+                else:
+                    parts += [name, ""]
+                end = m.end()
+            parts[-1] += value[end:]
+            names = parts[1::2]
+            if not names:
+                literal = parts[0]
+                return lambda host_vars: literal
+            self.names.update(names)
+
+            def render_str(host_vars: Dict[str, Optional[str]]) -> str:
+                out = [parts[0]]
+                for i in range(1, len(parts), 2):
+                    var = host_vars.get(parts[i])
+                    if not var:
+                        raise PatchError(f"no {parts[i]} for this host")
+                    out.append(var)
+                    out.append(parts[i + 1])
+                return "".join(out)
+            return render_str
+        if isinstance(value, dict):
+            members = [(k, self._compile(v)) for k, v in value.items()]
+            return lambda host_vars: {k: render(host_vars) for k, render in members}
+        if isinstance(value, list):
+            items = [self._compile(v) for v in value]
+            return lambda host_vars: [render(host_vars) for render in items]
+        return lambda host_vars: value
+
+    def render(self, host_vars: Dict[str, Optional[str]]) -> Any:
+        return self.render_value(host_vars)
+
+
+def template_vars(ip: str, hostname: Optional[str] = None,
+                  regions: Optional["RegionMap"] = None) -> Dict[str, Optional[str]]:
+    return {"ip": ip, "ip_dashed": ip.replace(".", "-").replace(":", "-"),
+            "ip_last": re.split(r"[.:]", ip)[-1], "hostname": hostname,
+            "region": regions.lookup(ip) if regions else None}
+
+
+class RegionMap:
+    """--regions file: {"<cidr>": "<region>", ..., "*": "<default>"}; the most specific network wins."""
+
+    def __init__(self, path: str):
+        with open(path, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+        if not isinstance(raw, dict) or not all(isinstance(v, str) for v in raw.values()):
+            raise ValueError("the regions file must be a JSON object of \"<cidr>\": \"<region>\"")
+        self.default = raw.pop("*", None)
+        networks = [(ip_network(cidr, strict=False), region) for cidr, region in raw.items()]
+        self.networks = sorted(networks, key=lambda item: item[0].prefixlen, reverse=True)
+
+    def lookup(self, ip: str) -> Optional[str]:
+        addr = ip_address(ip)
+        for net, region in self.networks:
+            if addr in net:
+                return region
+        return self.default
+
+
+_region_maps: Dict[Tuple[str, float], RegionMap] = {}
+_region_maps_lock = threading.Lock()
+
+
+def region_map(path: str) -> RegionMap:
+    """Process-wide RegionMap for path; a daemon picks up edits because the key includes the mtime."""
+    key = (path, os.path.getmtime(path))
+    with _region_maps_lock:
+        regions = _region_maps.get(key)
+        if regions is None:
+            regions = _region_maps[key] = RegionMap(path)
+        return regions
+
+
+class ConfigOps:
+    """A batch of config edits compiled once per run and applied per host in one parse/serialize pass.
+
+    Ops are RFC 6902-style dicts ({"op": "add"|"replace"|"remove"|"test",
+    "path": <JSON pointer>, "value": ...}) plus two pool extensions,
+    {"op": "enable-pools"|"disable-pools", "match": <URLs or UrlMatcher spec>},
+    which set "disabled" on every pool whose URL matches. The URL and
+    --set-pools-json flags are sugar over these (see from_flags). Strings in
+    op values may use ${var} templates, rendered per host by for_host();
+    self.ops keeps them as written (spec() for the daemon), the compiled
+    values have '$${' escapes resolved. templated=False takes values as final.
+    """
+
+    def __init__(self, ops: Iterable[Dict[str, Any]] = (), templated: bool = True):
+        self.ops: List[Dict[str, Any]] = []
+        self.compiled: List[Tuple[str, str, List[str], Optional[UrlMatcher], Any]] = []
+        self.templates: Dict[int, ValueTemplate] = {}
+        for op in ops:
+            kind = op.get("op")
+            if kind in POOL_OPS:
+                matcher = url_matcher(op.get("match"))
+                self.ops.append({"op": kind, "match": matcher.spec()})
+                self.compiled.append((kind, "/pools", ["pools"], matcher, None))
+            elif kind in PATCH_OPS:
+                path = op.get("path", "")
+                tokens = parse_json_pointer(path)
+                if kind != "remove" and "value" not in op:
+                    raise ValueError(f"{kind} {path}: missing 'value'")
+                self.ops.append({k: op[k] for k in ("op", "path", "value") if k in op})
+                value = op.get("value")
+                if templated:
+                    template = ValueTemplate(value)
+                    if template.names:
+                        self.templates[len(self.ops) - 1] = template
+                    else:
+                        value = template.render({})  # no placeholders, but '$${' escapes to resolve
+                self.compiled.append((kind, path, tokens, None, value))
+            else:
+                raise ValueError(f"unsupported op {kind!r} (expected one of {', '.join(PATCH_OPS + POOL_OPS)})")
+        self.key = json.dumps(self.ops, sort_keys=True)
+        self.template_names: FrozenSet[str] = frozenset().union(*(t.names for t in self.templates.values()))
+        self.renders: "OrderedDict[str, ConfigOps]" = OrderedDict()
+        self.render_lock = threading.Lock()
+        self.render_hits = 0
+        self.render_misses = 0
+
+    @classmethod
+    def from_flags(cls, disable_urls: UrlMatcher, enable_urls: UrlMatcher,
+                   new_pools: Optional[List[Dict[str, Any]]],
+                   extra: Iterable[Dict[str, Any]] = ()) -> "ConfigOps":
+        """The URL flags and --set-pools-json as ops, followed by extra ops.
+
+        As in update_pools_list(), a replacement pools list wins over the URL
+        flags, and enabling runs first so a pool matching both ends up disabled.
+        """
+        ops: List[Dict[str, Any]] = []
+        if new_pools is not None:
+            ops.append({"op": "add", "path": "/pools", "value": new_pools})
+        else:
+            if enable_urls:
+                ops.append({"op": "enable-pools", "match": enable_urls})
+            if disable_urls:
+                ops.append({"op": "disable-pools", "match": disable_urls})
+        ops.extend(extra)
+        return cls(ops)
+
+    def for_host(self, host_vars: Dict[str, Optional[str]]) -> "ConfigOps":
+        """These ops with their templates rendered for one host (self when there are none).
+
+        Renders are deduplicated by content: hosts that render to the same ops
+        share one compiled ConfigOps, which also keeps TRANSFORM_CACHE keys equal.
+        Raises PatchError when a variable has no value for the host.
+        """
+        if not self.templates:
+            return self
+        rendered = [dict(op, value=self.templates[i].render(host_vars)) if i in self.templates
+                    else dict(op, value=self.op_value(i)) if "value" in op else op
+                    for i, op in enumerate(self.ops)]
+        key = json.dumps(rendered, sort_keys=True)
+        with self.render_lock:
+            ops = self.renders.get(key)
+            if ops is not None:
+                self.renders.move_to_end(key)
+                self.render_hits += 1
+                return ops
+            self.render_misses += 1
+        ops = ConfigOps(rendered, templated=False)
+        with self.render_lock:
+            ops = self.renders.setdefault(key, ops)
+            while len(self.renders) > TEMPLATE_RENDER_CACHE_SIZE:
+                self.renders.popitem(last=False)
+        return ops
+
+    def apply(self, config: Any) -> None:
+        for kind, path, tokens, matcher, value in self.compiled:
+            if kind in POOL_OPS:
+                pools = config.get("pools") if isinstance(config, dict) else None
+                if isinstance(pools, list):
+                    if kind == "disable-pools":
+                        update_pools_list(pools, disable_urls=matcher)
+                    else:
+                        update_pools_list(pools, enable_urls=matcher)
+            else:
+                apply_patch_op(config, kind, path, tokens, value)
+
+    @property
+    def jq_args(self) -> Optional[Tuple[Dict[str, bool], Dict[str, bool], Any]]:
+        """($d, $e, $p) for REMOTE_EDIT_JQ, or None when the ops need the python editor."""
+        disable, enable, pools = {}, {}, None
+        for kind, path, _, matcher, value in self.compiled:
+            if kind in POOL_OPS and matcher.exact_only:
+                (disable if kind == "disable-pools" else enable).update({url: True for url in matcher.urls})
+            elif kind == "add" and path == "/pools" and len(self.compiled) == 1:
+                pools = value
+            else:
+                return None
+        return disable, enable, pools
+
+    def op_value(self, index: int) -> Any:
+        """The value of op index as applied (escapes resolved; templates rendered only after for_host())."""
+        return self.compiled[index][4]
+
+    def spec(self) -> List[Dict[str, Any]]:
+        """JSON form for the daemon header; ConfigOps(spec) compiles it again."""
+        return self.ops
+
+    def remote_spec(self) -> List[Dict[str, Any]]:
+        """Ops for REMOTE_EDIT_PY, with UrlMatchers in their compiled form."""
+        out = []
+        for (kind, _, _, matcher, value), op in zip(self.compiled, self.ops):
+            out.append({"op": kind, "match": matcher.remote_spec()} if matcher
+                       else dict(op, value=value) if "value" in op else op)
+        return out
+
+    def __bool__(self) -> bool:
+        return bool(self.ops)
+
+    def __eq__(self, other: Any) -> bool:
+        return isinstance(other, ConfigOps) and self.key == other.key
+
+    def __hash__(self) -> int:
+        return hash(self.key)
+
+    def __repr__(self) -> str:
+        return f"ConfigOps({self.key})"
+
+
+def parse_set_arg(arg: str) -> Dict[str, Any]:
+    """--set 'threads=8' / --set '/api-allow="0/0"' -> add op; the value is JSON, or a plain string if it isn't."""
+    path, sep, raw = arg.partition("=")
+    if not sep or not path:
+        raise ValueError(f"expected PATH=VALUE, got {arg!r}")
+    try:
+        value = json.loads(raw)
+    except ValueError:
+        value = raw
+    return {"op": "add", "path": path if path.startswith("/") else "/" + path, "value": value}
+
+
+def load_patch_file(path: str) -> List[Dict[str, Any]]:
+    with open(path, "r", encoding="utf-8") as f:
+        ops = json.load(f)
+    if not isinstance(ops, list) or not all(isinstance(op, dict) for op in ops):
+        raise ValueError("the patch file must be a JSON array of op objects")
+    return ops
+
+
+_JSON_WS = re.compile(r"[ \t\n\r]*")
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _skip_ws(text: str, i: int) -> int:
+    return _JSON_WS.match(text, i).end()
+
+
+def scan_json_object(text: str, i: int) -> Tuple[Dict[str, Tuple[Any, int, int]], int]:
+    """Parse the object starting at text[i] into {key: (value, start, end)} spans; returns (members, end)."""
+    if text[i] != "{":
+        raise ValueError(f"expected object at offset {i}")
+    members: Dict[str, Tuple[Any, int, int]] = {}
+    i = _skip_ws(text, i + 1)
+    if text[i] == "}":
+        return members, i + 1
+    while True:
+        if text[i] != '"':
+            raise ValueError(f"expected key at offset {i}")
+        key, i = json.decoder.scanstring(text, i + 1)
+        i = _skip_ws(text, i)
+        if text[i] != ":":
+            raise ValueError(f"expected ':' at offset {i}")
+        start = _skip_ws(text, i + 1)
+        value, end = _JSON_DECODER.raw_decode(text, start)
+        members[key] = (value, start, end)
+        i = _skip_ws(text, end)
+        if text[i] == "}":
+            return members, i + 1
+        if text[i] != ",":
+            raise ValueError(f"expected ',' or '}}' at offset {i}")
+        i = _skip_ws(text, i + 1)
+
+
+def scan_json_array(text: str, i: int) -> List[Tuple[Any, int, int]]:
+    """(value, start, end) for each element of the array starting at text[i]."""
+    if text[i] != "[":
+        raise ValueError(f"expected array at offset {i}")
+    items: List[Tuple[Any, int, int]] = []
+    i = _skip_ws(text, i + 1)
+    if text[i] == "]":
+        return items
+    while True:
+        value, end = _JSON_DECODER.raw_decode(text, i)
+        items.append((value, i, end))
+        i = _skip_ws(text, end)
+        if text[i] == "]":
+            return items
+        if text[i] != ",":
+            raise ValueError(f"expected ',' or ']' at offset {i}")
+        i = _skip_ws(text, i + 1)
+
+
+def locate_json_value(text: str, tokens: List[str]) -> Optional[Tuple[Any, int, int]]:
+    """(value, start, end) of the value at a JSON pointer in text, None if the path does not exist."""
+    start = _skip_ws(text, 0)
+    value, end = _JSON_DECODER.raw_decode(text, start)
+    for token in tokens:
+        if text[start] == "{":
+            members, _ = scan_json_object(text, start)
+            if token not in members:
+                return None
+            value, start, end = members[token]
+        elif text[start] == "[":
+            items = scan_json_array(text, start)
+            if not token.isdigit() or int(token) >= len(items):
+                return None
+            value, start, end = items[int(token)]
+        else:
+            return None
+    return value, start, end
+
+
+def _splice_value(text: str, start: int, end: int, value: Any) -> str:
+    """Replace text[start:end] with value, indented to match the line it sits on."""
+    line_start = text.rfind("\n", 0, start) + 1
+    indent = _JSON_WS.match(text, line_start).group().lstrip("\r\n")
+    rendered = json.dumps(value, indent=4).replace("\n", "\n" + indent)
+    return text[:start] + rendered + text[end:]
+
+
+def _splice_pool_flags(text: str, want: int, matcher: UrlMatcher) -> Optional[str]:
+    """Rewrite just the "disabled" values of matching pools; None if one has no "disabled" key."""
+    found = locate_json_value(text, ["pools"])
+    if found is None or not isinstance(found[0], list):
+        return text
+    edits = []
+    for pool, start, _ in scan_json_array(text, found[1]):
+        if not isinstance(pool, dict) or pool.get("url") not in matcher or pool.get("disabled") == want:
+            continue
+        members, _ = scan_json_object(text, start)
+        if "disabled" not in members:
+            return None
+        _, value_start, value_end = members["disabled"]
+        edits.append((value_start, value_end, str(want)))
+    for value_start, value_end, new in reversed(edits):
+        text = text[:value_start] + new + text[value_end:]
+    return text
+
+
+def patch_config_text(data: str, ops: ConfigOps) -> Optional[str]:
+    """Apply ops by splicing only the affected values into the original text.
+
+    enable/disable-pools rewrite just the matching "disabled" values;
+    add/replace of an existing object member swap only that value, indented
+    to match; test is checked in place. Everything else keeps its bytes.
+    Returns data itself when nothing changes, None when an op can't be
+    expressed as a splice (remove, new keys, array inserts, missing
+    "disabled", unparseable text). Raises PatchError for a failed test.
+    """
+    text = data
     try:
-        # Resolve actual config and backup paths
-        config_path = resolve_remote_path(client, CONFIG_PATH_RAW)
-        backup_dir = resolve_remote_path(client, BACKUP_DIR_RAW)
+        for kind, path, tokens, matcher, value in ops.compiled:
+            if kind in POOL_OPS:
+                text = _splice_pool_flags(text, 1 if kind == "disable-pools" else 0, matcher)
+                if text is None:
+                    return None
+                continue
+            found = locate_json_value(text, tokens)
+            if kind == "test":
+                if found is None:
+                    raise PatchError(f"test: no such path {path}")
+                if found[0] != value:
+                    raise PatchError(f"test failed at {path}")
+                continue
+            if kind == "remove" or found is None:
+                return None
+            if kind == "add":
+                parent = locate_json_value(text, tokens[:-1])
+                if parent is None or not isinstance(parent[0], dict):
+                    return None  # array add inserts rather than replaces
+            if found[0] != value:
+                text = _splice_value(text, found[1], found[2], value)
+    except PatchError:
+        raise
+    except (ValueError, IndexError):
+        return None
+    return text
+
+
+def render_config_update(data: str, ops: ConfigOps, preserve_format: bool = False) -> Optional[str]:
+    """Return the rewritten config.json text, or None when the ops change nothing.
+    With preserve_format, only the changed values are spliced into the original
+    text where possible. Raises ValueError if data is not valid JSON and
+    PatchError if an op cannot be applied."""
+    if preserve_format:
+        patched = patch_config_text(data, ops)
+        if patched is not None:
+            return None if patched == data else patched
+    config = json.loads(data)
+    before = copy.deepcopy(config)
+    ops.apply(config)
+    if config == before:
+        return None
+    return json.dumps(config, indent=4)
+
+
+class TransformCache:
+    """Thread-safe LRU of rendered configs keyed by (sha256 of the config bytes, ops).
+
+    Fleets mostly run byte-identical configs, so the parse/update/serialize
+    work is done once per distinct config and every other host gets the
+    already-encoded bytes. Unchanged results (None) are cached too; errors are not.
+    """
+
+    def __init__(self, maxsize: int = TRANSFORM_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries: "OrderedDict[Tuple[str, Any], Optional[bytes]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, data: str, ops: ConfigOps, preserve_format: bool = False) -> Optional[bytes]:
+        key = (hashlib.sha256(data.encode("utf-8")).hexdigest(), ops, preserve_format)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+
+        new_json = render_config_update(data, ops, preserve_format)
+        out = None if new_json is None else new_json.encode("utf-8")
+        with self.lock:
+            self.entries[key] = out
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return out
+
+
+TRANSFORM_CACHE = TransformCache()
+
+
+def finish_timings(result: Dict[str, Any], timer: PhaseTimer) -> None:
+    """Attach phase durations, plus raw spans and the worker name for --trace (main() pops those)."""
+    result["timings"] = timer.durations()
+    result["spans"] = timer.spans
+    result.setdefault("worker", threading.current_thread().name)
+
+
+def drift_verdict(result: Dict[str, Any], info: Dict[str, Any], drift_hash: str, push_drifted: bool) -> bool:
+    """Fill result from a drift check; returns True when the host should go on to be rewritten."""
+    if "error" in info:
+        result["msg"] = "{}: {}".format(*info["error"])
+        return False
+    result["drifted"] = info["pools_sha256"] != drift_hash
+    if not result["drifted"]:
+        result["unchanged"] = True
+        result["success"] = True
+        result["msg"] = "in sync"
+        return False
+    if push_drifted:
+        return True
+    result["success"] = True
+    result["msg"] = f"drifted (pools sha256 {info['pools_sha256'][:12]}, hashed by {info.get('hashed_by', '?')})"
+    return False
+
+
+def snapshot_verdict(result: Dict[str, Any], prep: Dict[str, Any], snapshot_dir: str) -> None:
+    """Store a pulled config in the snapshot store and fill result with its hash."""
+    if "error" in prep:
+        result["msg"] = "{}: {}".format(*prep["error"])
+        return
+    data = prep["data"].encode("utf-8")
+    try:
+        result["sha256"] = store_snapshot(snapshot_dir, data)
+    except OSError as e:
+        result["msg"] = f"snapshot store failed: {type(e).__name__}: {e}"
+        return
+    result["size"] = len(data)
+    result["success"] = True
+    result["msg"] = f"pulled {len(data)} bytes (sha256 {result['sha256'][:12]})"
+
+
+def edit_verdict(result: Dict[str, Any], edit: Dict[str, Any]) -> bool:
+    """Fill result from a remote edit; False means the host had no interpreter and needs the local path."""
+    if edit.get("edit") == "unsupported":
+        return False
+    if "error" in edit:
+        result["msg"] = "{}: {}".format(*edit["error"])
+    elif edit["edit"] == "updated":
+        result["updated"] = True
+        result["msg"] = f"config updated (edited by {edit.get('edited_by')})"
+    else:
+        result["unchanged"] = True
+        result["msg"] = "config unchanged"
+    return True
 
-        if disable_url or enable_url or new_pools is not None:
-            ok, bak_msg = make_remote_backup(client, config_path, backup_dir)
-            if not ok:
-                result["msg"] = f"backup failed: {bak_msg}"
-                client.close()
-                return result
 
-            try:
-                sftp = client.open_sftp()
-                with sftp.open(config_path, 'r') as rf:
-                    data = rf.read().decode('utf-8')
-            except IOError as e:
-                result["msg"] = f"read config failed: {type(e).__name__}: {e}"
-                client.close()
-                return result
+def render_host_ops(result: Dict[str, Any], ops: ConfigOps, ip: str, regions: Optional[RegionMap],
+                    hostname: Optional[str] = None) -> Optional[ConfigOps]:
+    """Render templated ops for this host; None (with result['msg'] set) when a variable has no value.
 
+    Ops that use ${hostname} stay unrendered while hostname is None: it comes
+    from the prepare/drift output, so callers render again once that is read
+    (passing "" when the host did not report one).
+    """
+    if not ops.template_names or ("hostname" in ops.template_names and hostname is None):
+        return ops
+    try:
+        return ops.for_host(template_vars(ip, hostname, regions))
+    except PatchError as e:
+        result["msg"] = f"template failed: {e}"
+        return None
+
+
+OPS_FILE_VERBS = ("disable", "enable", "disable-match", "enable-match")
+
+
+def load_ops_file(path: str) -> Dict[str, Set[str]]:
+    """Read '<verb> <url-or-selector>' lines into {verb: set}; verbs are OPS_FILE_VERBS.
+    Blank lines and lines starting with '#' are skipped."""
+    ops: Dict[str, Set[str]] = {verb: set() for verb in OPS_FILE_VERBS}
+    with open(path, "r", encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            verb, _, arg = line.partition(" ")
+            arg = arg.strip()
+            if verb not in ops or not arg:
+                raise ValueError(f"{path}:{lineno}: expected one of {', '.join(OPS_FILE_VERBS)} followed by a URL")
+            ops[verb].add(arg)
+    return ops
+
+
+def connect_failed(result: Dict[str, Any], timer: PhaseTimer, e: Exception) -> None:
+    """Fill result for a failed connect; timeouts record the phase they hit, --workers auto's congestion signal."""
+    result["msg"] = f"SSH connect failed: {type(e).__name__}: {e}"
+    # Only a TCP connect that got no answer: a host that stalls in the handshake is up, just slow
+    result["unreachable"] = timer.failed == "tcp_connect" and unreachable_error(e)
+    if isinstance(e, (socket.timeout, asyncio.TimeoutError)):
+        result["timed_out_phase"] = timer.failed or "tcp_connect"
+
+
+def host_steps(result: Dict[str, Any], timer: PhaseTimer, ip: str, port: int,
+               ops: ConfigOps,
+               do_switchpool: bool,
+               switch_method: str = "auto",
+               switch_timeout: float = SWITCHPOOL_TIMEOUT,
+               switch_if_changed: bool = False,
+               drift_hash: Optional[str] = None,
+               push_drifted: bool = False,
+               snapshot_dir: Optional[str] = None,
+               preserve_format: bool = False,
+               remote_edit_mode: bool = False,
+               probe_cache: Optional[str] = None,
+               probe_ttl: float = PROBE_TTL,
+               regions: Optional[str] = None) -> Generator[Tuple[Any, ...], Any, None]:
+    """Everything process_host() and async_process_host() do once connected, filling result in place.
+
+    Yields (step, *args) for each remote operation, step being a key of
+    HOST_STEPS / ASYNC_HOST_STEPS; the driver runs it on its connection and
+    sends back the return value, or throws in the exception it raised.
+    """
+    if snapshot_dir:
+        try:
+            with timer.phase("prepare"):
+                prep = yield ("prepare",)
+        except Exception as e:
+            prep = {"error": ("read config failed", f"{type(e).__name__}: {e}")}
+        snapshot_verdict(result, prep, snapshot_dir)
+        return
+
+    # Templated ops render here, or once prepare/drift has read the hostname when they use ${hostname}
+    templated = bool(ops.template_names)
+    region_lookup = region_map(regions) if regions else None
+    ops = render_host_ops(result, ops, ip, region_lookup)
+    if ops is None:
+        return
+
+    caps = None
+    if probe_cache:
+        # Known hosts skip straight to the mechanisms they support
+        cache = capability_cache(probe_cache, probe_ttl)
+        fingerprint = host_key_fingerprint((yield ("host_key",)))
+        caps = cache.get(ip, port, fingerprint)
+        if caps is None:
             try:
-                config = json.loads(data)
-            except Exception as e:
-                result["msg"] = f"json parse failed: {type(e).__name__}: {e}"
-                client.close()
-                return result
-
-            user_val = config.get("user")
+                with timer.phase("probe"):
+                    caps = yield ("probe", switch_timeout)
+                cache.put(ip, port, fingerprint, caps)
+            except Exception:
+                caps = None
+        result["caps"] = caps
+
+    prep = None
+    if drift_hash is not None:
+        # Compare a remote hash of the pools array; only drifted hosts go further
+        try:
+            with timer.phase("drift"):
+                info = yield ("drift",)
+        except Exception as e:
+            info = {"error": ("drift check failed", f"{type(e).__name__}: {e}")}
+        if "error" not in info:
+            ops = render_host_ops(result, ops, ip, region_lookup, info.get("hostname", ""))
+            if ops is None:
+                return
+            if templated:
+                drift_hash = pools_hash(ops.op_value(0))  # --check-drift ops are the lone add /pools
+        if not drift_verdict(result, info, drift_hash, push_drifted):
+            return
+        if "data" in info:
+            prep = info
+
+    edited = False
+    can_edit_remotely = caps is None or caps["python"] or (caps["jq"] and ops.jq_args is not None)
+    if remote_edit_mode and can_edit_remotely and prep is None and ops and not ops.template_names:
+        # Edit, back up and rename on the host in one exec
+        try:
+            with timer.phase("edit"):
+                edit = yield ("edit", ops)
+        except Exception as e:
+            edit = {"error": ("remote edit failed", f"{type(e).__name__}: {e}")}
+        edited = edit_verdict(result, edit)
+        if edited and "error" in edit:
+            return
 
-            pools_existing = config.get("pools", [])
-            pools_updated = update_pools_list(pools_existing, disable_url=disable_url, enable_url=enable_url, new_pools=new_pools)
-            config["pools"] = pools_updated
+    if not edited and ops:
+        # Resolve paths and read config.json in one round trip
+        try:
+            if prep is None:
+                with timer.phase("prepare"):
+                    prep = yield ("prepare",)
+        except Exception as e:
+            prep = {"error": ("read config failed", f"{type(e).__name__}: {e}")}
+        if "error" in prep:
+            stage, detail = prep["error"]
+            result["msg"] = f"{stage}: {detail}"
+            return
+        ops = render_host_ops(result, ops, ip, region_lookup, prep.get("hostname", ""))
+        if ops is None:
+            return
 
-            if user_val is not None:
-                config["user"] = user_val
+        try:
+            new_json = TRANSFORM_CACHE.render(prep["data"], ops, preserve_format)
+        except PatchError as e:
+            result["msg"] = f"patch failed: {e}"
+            return
+        except Exception as e:
+            result["msg"] = f"json parse failed: {type(e).__name__}: {e}"
+            return
 
+        if new_json is None:
+            # Nothing to change: no backup rotation, no write
+            result["unchanged"] = True
+            result["msg"] = "config unchanged"
+        else:
             try:
-                new_json = json.dumps(config, indent=4)
-                with sftp.open(config_path, 'w') as wf:
-                    wf.write(new_json)
+                with timer.phase("write"):
+                    failure = yield ("commit", prep["config_path"], prep["backup_dir"], new_json,
+                                     prep["data"].encode("utf-8")
+                                     if preserve_format and (caps is None or caps["dd"]) else None)
             except Exception as e:
-                result["msg"] = f"write config failed: {type(e).__name__}: {e}"
-                client.close()
-                return result
+                failure = ("write config failed", f"{type(e).__name__}: {e}")
+            if failure:
+                result["msg"] = "{}: {}".format(*failure)
+                return
 
             result["updated"] = True
             result["msg"] = "config updated"
 
-        if do_switchpool:
-            switched_ok, switched_msg = remote_send_switchpool(client)
+    if do_switchpool:
+        if result["unchanged"] and switch_if_changed:
+            switched_msg = "skipped (config unchanged)"
+        else:
+            with timer.phase("switchpool"):
+                switched_ok, switched_msg = yield ("switchpool", pick_switch_method(switch_method, caps),
+                                                   switch_timeout)
             result["switched"] = switched_ok
-            if result["msg"]:
-                result["msg"] += " | "
-            result["msg"] += f"switchpool: {switched_msg}"
+            if caps is not None and not switched_ok:
+                cache.invalidate(ip, port)  # re-probe next run in case the host changed
+        if result["msg"]:
+            result["msg"] += " | "
+        result["msg"] += f"switchpool: {switched_msg}"
+
+    result["success"] = bool(result["updated"] or result["unchanged"] or result["switched"])
+
+
+HOST_STEPS: Dict[str, Callable[..., Any]] = {
+    "prepare": remote_prepare,
+    "host_key": lambda transport: transport.get_remote_server_key().asbytes(),
+    "probe": remote_probe,
+    "drift": remote_drift_check,
+    "edit": remote_edit,
+    "commit": remote_commit,
+    "switchpool": remote_send_switchpool,
+}
+
+
+def run_host_steps(steps: Generator[Tuple[Any, ...], Any, None], transport: paramiko.Transport) -> Optional[float]:
+    """Drive host_steps() on a paramiko transport; returns how long the first remote exec took, if any ran."""
+    reply: Any = None
+    error: Optional[Exception] = None
+    rtt = None
+    while True:
+        try:
+            step = steps.send(reply) if error is None else steps.throw(error)
+        except StopIteration:
+            return rtt
+        reply, error = None, None
+        started = time.monotonic()
+        try:
+            reply = HOST_STEPS[step[0]](transport, *step[1:])
+        except Exception as e:
+            error = e
+        if rtt is None and step[0] != "host_key":
+            rtt = time.monotonic() - started
+
 
-        result["success"] = bool(result["updated"] or result["switched"])
+def process_host(ip: str, username: str, password: str, port: int,
+                 pool: Optional["TransportPool"] = None, **options: Any) -> Dict[str, Any]:
+    """Connect (or borrow a pooled transport) and run host_steps() with options; returns the result dict."""
+    result = new_result(ip)
+    result["port"] = port
+    timer = PhaseTimer()
+    started = time.monotonic()
 
+    try:
+        if pool:
+            transport = pool.acquire(ip, port, username, password, timer)
+        else:
+            transport = open_transport(ip, port, username, password, timer)
+    except Exception as e:
+        connect_failed(result, timer, e)
+        timer.add("total", started, time.monotonic())
+        finish_timings(result, timer)
+        return result
+
+    try:
+        rtt = run_host_steps(host_steps(result, timer, ip, port, **options), transport)
+        if rtt is not None:
+            result["rtt"] = round(rtt, 4)  # --workers auto's latency sample, warm pooled transport or not
     except Exception as e:
         result["msg"] = f"Unhandled error: {type(e).__name__}: {e}"
     finally:
         try:
-            if sftp:
-                sftp.close()
+            if pool:
+                pool.release(ip, port, username, password)
+            else:
+                transport.close()
         except Exception:
             pass
+        timer.add("total", started, time.monotonic())
+        finish_timings(result, timer)
+
+    return result
+
+
+# ---------------- asyncio engine (asyncssh) ----------------
+async def async_run_ssh_command_raw(conn, cmd: str, stdin_data: Optional[bytes] = None) -> Tuple[int, bytes, bytes]:
+    r = await conn.run(cmd, check=False, encoding=None, input=stdin_data)
+    return r.exit_status or 0, r.stdout or b"", r.stderr or b""
+
+
+async def async_run_ssh_command(conn, cmd: str) -> Tuple[int, str, str]:
+    es, out, err = await async_run_ssh_command_raw(conn, cmd)
+    return es, out.decode("utf-8", errors="ignore"), err.decode("utf-8", errors="ignore")
+
+
+async def async_remote_prepare(conn) -> Dict[str, Any]:
+    es, out, err = await async_run_ssh_command_raw(conn, prepare_script())
+    return parse_prepare_output(es, out, err)
+
+
+async def async_remote_drift_check(conn) -> Dict[str, Any]:
+    es, out, err = await async_run_ssh_command_raw(conn, drift_script())
+    return parse_drift_output(es, out, err)
+
+
+async def async_remote_edit(conn, ops: "ConfigOps") -> Dict[str, Any]:
+    es, out, err = await async_run_ssh_command_raw(conn, remote_edit_script(ops))
+    return parse_edit_output(es, out, err)
+
+
+async def async_remote_commit(conn, config_path: str, backup_dir: str, new_data: bytes,
+                              old_data: Optional[bytes] = None) -> Optional[Tuple[str, str]]:
+    edits = inplace_edits(old_data, new_data) if old_data is not None else None
+    if edits:
+        es, out, err = await async_run_ssh_command_raw(conn, patch_script(config_path, backup_dir, edits, old_data))
+        if es != PATCH_UNSUPPORTED:
+            return commit_error(es, out, err)
+    es, out, err = await async_run_ssh_command_raw(conn, commit_script(config_path, backup_dir), stdin_data=new_data)
+    return commit_error(es, out, err)
+
+
+async def async_remote_send_switchpool_telnet(conn, cmd: str = SWITCHPOOL_TELNET_CMD) -> Tuple[bool, str]:
+    es, out, err = await async_run_ssh_command(conn, cmd)
+    combined = (out + err).lower()
+    if "ok|" in combined:
+        return True, "switchpool ok"
+    return False, combined.strip() or f"exit_status={es}"
+
+
+async def async_api_command_via_tunnel(conn, command: str, timeout: float) -> str:
+    reader, writer = await asyncio.wait_for(
+        conn.open_connection(CCMINER_API_HOST, CCMINER_API_PORT), timeout=timeout)
+    try:
+        writer.write(command.encode())
+        reply = b""
+
+        async def read_reply() -> None:
+            nonlocal reply
+            while b"|" not in reply:
+                chunk = await reader.read(4096)
+                if not chunk:
+                    break
+                reply += chunk
+
+        await asyncio.wait_for(read_reply(), timeout=timeout)
+        return reply.decode("utf-8", errors="ignore")
+    finally:
+        writer.close()
+
+
+async def async_remote_send_switchpool(conn, method: str = "auto",
+                                       timeout: float = SWITCHPOOL_TIMEOUT) -> Tuple[bool, str]:
+    if method == "none":
+        return False, "no way to reach the ccminer API (no TCP forwarding, telnet or nc)"
+    if method == "nc":
+        return await async_remote_send_switchpool_telnet(conn, SWITCHPOOL_NC_CMD)
+    if method in ("auto", "tunnel"):
         try:
-            client.close()
-        except Exception:
-            pass
+            reply = await async_api_command_via_tunnel(conn, "switchpool", timeout)
+        except asyncio.TimeoutError:
+            return False, f"tunnel timeout: no API reply within {timeout}s"
+        except (asyncssh.Error, OSError) as e:
+            if method == "tunnel":
+                return False, f"tunnel failed: {type(e).__name__}: {e}"
+        else:
+            if "ok|" in reply.lower():
+                return True, "switchpool ok"
+            return False, reply.strip() or "empty API reply"
+    return await async_remote_send_switchpool_telnet(conn)
+
+
+async def async_probe_forwarding(conn, timeout: float) -> Optional[bool]:
+    try:
+        reader, writer = await asyncio.wait_for(
+            conn.open_connection(CCMINER_API_HOST, CCMINER_API_PORT), timeout=timeout)
+    except asyncssh.ChannelOpenError as e:
+        return False if e.code == asyncssh.OPEN_ADMINISTRATIVELY_PROHIBITED else None
+    except (asyncssh.Error, OSError, asyncio.TimeoutError):
+        return None
+    writer.close()
+    return True
+
+
+async def async_remote_probe(conn, timeout: float = SWITCHPOOL_TIMEOUT) -> Dict[str, Any]:
+    es, out, err = await async_run_ssh_command(conn, probe_script())
+    if es != 0:
+        raise IOError(err.strip() or f"probe exit_status={es}")
+    caps = parse_probe_output(out)
+    caps["forwarding"] = await async_probe_forwarding(conn, timeout)
+    return caps
+
+
+async def async_remote_host_key(conn) -> bytes:
+    return conn.get_server_host_key().public_data
+
+
+async def async_open_connection(ip: str, port: int, username: str, password: str, timer: PhaseTimer):
+    """asyncssh connect with tcp_connect / kex / auth recorded like open_transport()."""
+    loop = asyncio.get_running_loop()
+    with timer.phase("tcp_connect"):
+        family, type_, proto, _, addr = (await loop.getaddrinfo(ip, port, type=socket.SOCK_STREAM))[0]
+        sock = socket.socket(family, type_, proto)
+        sock.setblocking(False)
+        try:
+            await asyncio.wait_for(loop.sock_connect(sock, addr), timeout=SSH_CONNECT_TIMEOUT)
+        except BaseException:
+            sock.close()
+            raise
+
+    marks = {"kex": time.monotonic()}
+
+    class PhaseTimingClient(asyncssh.SSHClient):
+        def begin_auth(self, username: str) -> bool:
+            marks["auth"] = time.monotonic()
+            timer.add("kex", marks["kex"], marks["auth"])
+            return True
+
+        def auth_completed(self) -> None:
+            timer.add("auth", marks["auth"], time.monotonic())
+
+    try:
+        return await asyncio.wait_for(
+            asyncssh.connect(sock=sock, host=ip, username=username, password=password, known_hosts=None,
+                             preferred_auth="password,keyboard-interactive", client_factory=PhaseTimingClient),
+            timeout=SSH_CONNECT_TIMEOUT)
+    except BaseException:
+        timer.failed = timer.failed or ("auth" if "auth" in marks else "kex")
+        sock.close()
+        raise
+
+
+ASYNC_HOST_STEPS: Dict[str, Callable[..., Awaitable[Any]]] = {
+    "prepare": async_remote_prepare,
+    "host_key": async_remote_host_key,
+    "probe": async_remote_probe,
+    "drift": async_remote_drift_check,
+    "edit": async_remote_edit,
+    "commit": async_remote_commit,
+    "switchpool": async_remote_send_switchpool,
+}
+
+
+async def async_run_host_steps(steps: Generator[Tuple[Any, ...], Any, None], conn) -> Optional[float]:
+    """Drive host_steps() on an asyncssh connection, like run_host_steps()."""
+    reply: Any = None
+    error: Optional[Exception] = None
+    rtt = None
+    while True:
+        try:
+            step = steps.send(reply) if error is None else steps.throw(error)
+        except StopIteration:
+            return rtt
+        reply, error = None, None
+        started = time.monotonic()
+        try:
+            reply = await ASYNC_HOST_STEPS[step[0]](conn, *step[1:])
+        except Exception as e:
+            error = e
+        if rtt is None and step[0] != "host_key":
+            rtt = time.monotonic() - started
+
+
+async def async_process_host(ip: str, username: str, password: str, port: int, **options: Any) -> Dict[str, Any]:
+    """asyncssh twin of process_host(); returns the same result dict."""
+    result = new_result(ip)
+    result["port"] = port
+    timer = PhaseTimer()
+    started = time.monotonic()
+
+    try:
+        conn = await async_open_connection(ip, port, username, password, timer)
+    except Exception as e:
+        connect_failed(result, timer, e)
+        timer.add("total", started, time.monotonic())
+        finish_timings(result, timer)
+        return result
+
+    try:
+        rtt = await async_run_host_steps(host_steps(result, timer, ip, port, **options), conn)
+        if rtt is not None:
+            result["rtt"] = round(rtt, 4)
+    except Exception as e:
+        result["msg"] = f"Unhandled error: {type(e).__name__}: {e}"
+    finally:
+        conn.close()
+        timer.add("total", started, time.monotonic())
+        finish_timings(result, timer)
 
     return result
 
 
+# ---------------- execution engines ----------------
+def network_segment(ip: str) -> str:
+    """The /24 (IPv4) or /64 (IPv6) an address sits in: the unit --workers auto tunes separately."""
+    addr = ip_address(ip)
+    return str(ip_network(f"{addr}/{24 if addr.version == 4 else 64}", strict=False))
+
+
+def congestion_signal(res: Dict[str, Any]) -> bool:
+    """A connect or handshake that timed out, as opposed to a refused port or a wrong password."""
+    return bool(res.get("timed_out_phase"))
+
+
+class SegmentState:
+    def __init__(self, start: float):
+        self.limit = start
+        self.inflight = 0
+        self.epoch = 0  # bumped on every back-off; results from hosts submitted earlier cannot trigger another
+        self.latency: Optional[float] = None  # EWMA of the first remote exec's round trip
+        self.baseline: Optional[float] = None  # lowest latency EWMA seen
+        self.peak = int(start)
+        self.optimum = 0  # highest limit that ran a full window without latency growth or timeouts
+        self.backoffs = 0
+        self.done = 0
+
+
+class AimdController:
+    """--workers auto: additive-increase / multiplicative-decrease concurrency per network segment.
+
+    Latency is each host's first remote exec round trip (result 'rtt'), which
+    daemon jobs on warm transports have too, unlike connect + key-exchange
+    timings. Every completion on a segment with flat latency adds 1/limit
+    (one worker per window, as in TCP congestion avoidance); a handshake
+    timeout or a latency spike above AIMD_LATENCY_SPIKE x baseline halves the
+    limit, at most once per cohort of in-flight hosts. Latency between the
+    tolerance and the spike holds the limit. The reported optimum is the
+    largest limit that completed a full window cleanly, '-' if none did.
+    """
+
+    def __init__(self, start: int = AIMD_START, max_workers: int = AIMD_MAX_WORKERS):
+        self.start = start
+        self.max_workers = max_workers
+        self.segments: Dict[str, SegmentState] = {}
+        self.imported: Optional[List[Dict[str, Any]]] = None  # report rows sent back by a --daemon
+
+    def state(self, segment: str) -> SegmentState:
+        st = self.segments.get(segment)
+        if st is None:
+            st = self.segments[segment] = SegmentState(self.start)
+        return st
+
+    def has_room(self, segment: str) -> bool:
+        st = self.state(segment)
+        return st.inflight < int(st.limit)
+
+    def submitted(self, segment: str) -> int:
+        st = self.state(segment)
+        st.inflight += 1
+        return st.epoch
+
+    def observe(self, segment: str, epoch: int, res: Dict[str, Any]) -> None:
+        st = self.state(segment)
+        st.inflight -= 1
+        st.done += 1
+        sample = res.get("rtt")
+        if sample is not None:
+            st.latency = sample if st.latency is None else st.latency + AIMD_LATENCY_ALPHA * (sample - st.latency)
+            st.baseline = st.latency if st.baseline is None else min(st.baseline, st.latency)
+
+        spiked = sample is not None and st.baseline is not None and sample > st.baseline * AIMD_LATENCY_SPIKE
+        if congestion_signal(res) or spiked:
+            if epoch == st.epoch:
+                st.limit = max(1.0, st.limit * AIMD_DECREASE)
+                st.epoch += 1
+                st.backoffs += 1
+            return
+        if sample is None or st.latency > st.baseline * AIMD_LATENCY_TOLERANCE:
+            return  # no exec to judge by, or latency creeping up: hold
+        before = int(st.limit)
+        st.limit = min(float(self.max_workers), st.limit + 1.0 / st.limit)
+        if int(st.limit) > before:
+            st.optimum = max(st.optimum, before)
+            st.peak = max(st.peak, int(st.limit))
+
+    def report(self) -> List[Dict[str, Any]]:
+        if self.imported is not None:
+            return self.imported
+        rows = []
+        for segment, st in sorted(self.segments.items()):
+            rows.append({"segment": segment, "hosts": st.done, "optimum": st.optimum or "-",
+                         "final": int(st.limit), "peak": st.peak, "backoffs": st.backoffs,
+                         "baseline": st.baseline})
+        return rows
+
+
+def interleave_segments(hosts: Iterable[Any], window: int = AIMD_INTERLEAVE_WINDOW) -> Iterator[Any]:
+    """Deal hosts round-robin across network segments within consecutive windows, keeping each segment's order.
+
+    Ranges arrive one /24 after another; interleaving lets --workers auto run
+    every segment up to its own limit at once instead of a segment at a time.
+    """
+    host_iter = iter(hosts)
+    while True:
+        chunk = list(itertools.islice(host_iter, window))
+        if not chunk:
+            return
+        by_segment: "OrderedDict[str, deque]" = OrderedDict()
+        for target in chunk:
+            by_segment.setdefault(network_segment(split_target(target)[0]), deque()).append(target)
+        queues = list(by_segment.values())
+        while queues:
+            for waiting in queues:
+                yield waiting.popleft()
+            queues = [waiting for waiting in queues if waiting]
+
+
+def run_adaptive_thread_engine(hosts: Iterable[Any], job_kwargs: Dict[str, Any],
+                               controller: AimdController) -> Iterator[Dict[str, Any]]:
+    """run_thread_engine() with per-segment AIMD limits from controller instead of a fixed worker count.
+
+    Hosts are interleaved across segments (interleave_segments()). A host
+    whose segment is at its limit is parked, at most that limit per segment
+    and max_workers in all, so one segment cannot fill the queue; parked
+    hosts go first whenever their segment frees a slot.
+    """
+    host_iter = interleave_segments(hosts)
+    exhausted = False
+    pending: Optional[Tuple[Any, str]] = None  # next host, waiting for parking room in its segment
+    parked: "OrderedDict[str, deque]" = OrderedDict()
+    parked_count = 0
+    with ThreadPoolExecutor(max_workers=controller.max_workers) as ex:
+        future_info: Dict[Any, Tuple[str, str, int]] = {}
+
+        def submit(target: Any, segment: str) -> None:
+            ip, overrides = split_target(target)
+            epoch = controller.submitted(segment)
+            future_info[ex.submit(process_host, ip, **host_job(job_kwargs, overrides))] = (ip, segment, epoch)
+
+        while True:
+            for segment, waiting in parked.items():
+                while waiting and controller.has_room(segment):
+                    submit(waiting.popleft(), segment)
+                    parked_count -= 1
+            while not exhausted and len(future_info) < controller.max_workers and parked_count < controller.max_workers:
+                if pending is None:
+                    target = next(host_iter, None)
+                    if target is None:
+                        exhausted = True
+                        break
+                    pending = (target, network_segment(split_target(target)[0]))
+                target, segment = pending
+                waiting = parked.get(segment)
+                if controller.has_room(segment) and not waiting:
+                    submit(target, segment)
+                elif not waiting or len(waiting) < int(controller.state(segment).limit):
+                    parked.setdefault(segment, deque()).append(target)
+                    parked_count += 1
+                else:
+                    break  # its segment's queue is full; wait for a slot there
+                pending = None
+            if not future_info:
+                break
+
+            finished, _ = wait(future_info, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                ip, segment, epoch = future_info.pop(fut)
+                try:
+                    res = fut.result()
+                except Exception as e:
+                    res = new_result(ip, f"executor error: {e}")
+                controller.observe(segment, epoch, res)
+                yield res
+
+
+def run_thread_engine(hosts: Iterable[Any], job_kwargs: Dict[str, Any], workers: int) -> Iterator[Dict[str, Any]]:
+    """Run process_host on a ThreadPoolExecutor, yielding results as they complete.
+
+    Hosts are pulled lazily and at most workers * SUBMIT_WINDOW_FACTOR are submitted
+    at a time, so memory does not grow with the size of the range.
+    """
+    window = max(1, workers * SUBMIT_WINDOW_FACTOR)
+    host_iter = iter(hosts)
+    exhausted = False
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        future_to_ip = {}
+        while True:
+            while not exhausted and len(future_to_ip) < window:
+                target = next(host_iter, None)
+                if target is None:
+                    exhausted = True
+                    break
+                ip, overrides = split_target(target)
+                future_to_ip[ex.submit(process_host, ip, **host_job(job_kwargs, overrides))] = ip
+            if not future_to_ip:
+                break
+
+            finished, _ = wait(future_to_ip, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                ip = future_to_ip.pop(fut)
+                try:
+                    res = fut.result()
+                except Exception as e:
+                    res = new_result(ip, f"executor error: {e}")
+                yield res
+
+
+def run_asyncio_engine(hosts: Iterable[Any], job_kwargs: Dict[str, Any], concurrency: int) -> Iterator[Dict[str, Any]]:
+    """Run async_process_host for all hosts on one event loop (in a helper thread),
+    yielding results as they complete so main() can report them like the thread engine.
+
+    concurrency is capped by open_files_budget(), like prescan_hosts(): every
+    host in flight holds a socket until its (possibly slow) connect gives up.
+    """
+    budget = open_files_budget()
+    if budget is not None:
+        concurrency = max(1, min(concurrency, budget))
+    host_iter = iter(hosts)
+    no_more = object()
+
+    async def run_all(put: Callable[[Any], Awaitable[None]]) -> None:
+        loop = asyncio.get_running_loop()
+        sem = asyncio.Semaphore(concurrency)
+        pending = set()
+        free_slots = list(range(concurrency, 0, -1))
+
+        async def run_one(target: Any) -> None:
+            # A slot number stands in for a worker thread (one --trace track per slot)
+            slot = free_slots.pop()
+            ip, overrides = split_target(target)
+            try:
+                try:
+                    res = await async_process_host(ip, **host_job(job_kwargs, overrides))
+                except Exception as e:
+                    res = new_result(ip, f"executor error: {e}")
+                res["worker"] = f"slot-{slot}"
+                await put(res)
+            finally:
+                free_slots.append(slot)
+                sem.release()
+
+        while True:
+            await sem.acquire()
+            # The host iterator may block (e.g. pre-scan feed), so never call it on the loop
+            target = await loop.run_in_executor(None, next, host_iter, no_more)
+            if target is no_more:
+                break
+            task = asyncio.ensure_future(run_one(target))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        if pending:
+            await asyncio.gather(*pending)
+
+    return iter_async_producer(run_all, "asyncio-engine", maxsize=concurrency)
+
+
+# ---------------- results / reporting ----------------
+class ResultSink:
+    """Write each host result as one JSON line, flushing in batches so a crash loses at most one batch."""
+
+    def __init__(self, path: str, flush_every: int = RESULTS_FLUSH_EVERY,
+                 flush_interval: float = RESULTS_FLUSH_INTERVAL):
+        self.f = open(path, "w", encoding="utf-8")
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+
+    def write(self, res: Dict[str, Any]) -> None:
+        self.f.write(json.dumps(res, default=str) + "\n")
+        self.unflushed += 1
+        if self.unflushed >= self.flush_every or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        self.f.flush()
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+
+    def close(self) -> None:
+        self.flush()
+        self.f.close()
+
+
+class TraceWriter:
+    """Stream Chrome/Perfetto Trace Event Format: one track per worker, one span per host phase.
+
+    Events are written as they arrive (JSON object format, closed on close()), so
+    the file stays loadable up to the last completed host if the run is killed.
+    """
+
+    def __init__(self, path: str, run_start: float):
+        self.f = open(path, "w", encoding="utf-8")
+        self.run_start = run_start
+        self.tids: Dict[str, int] = {}
+        self.first = True
+        self.f.write('{"displayTimeUnit": "ms", "traceEvents": [\n')
+        self._emit({"name": "process_name", "ph": "M", "pid": 1, "args": {"name": "update_pools"}})
+
+    def _emit(self, event: Dict[str, Any]) -> None:
+        self.f.write(("" if self.first else ",\n") + json.dumps(event))
+        self.first = False
+
+    def _us(self, t: float) -> int:
+        return int((t - self.run_start) * 1_000_000)
+
+    def add_host(self, ip: str, worker: str, spans: List[Tuple[str, float, float]]) -> None:
+        tid = self.tids.get(worker)
+        if tid is None:
+            tid = self.tids[worker] = len(self.tids) + 1
+            self._emit({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": worker}})
+        for name, start, end in spans:
+            self._emit({"name": ip if name == "total" else name, "cat": "host" if name == "total" else "phase",
+                        "ph": "X", "pid": 1, "tid": tid, "ts": self._us(start),
+                        "dur": max(0, self._us(end) - self._us(start)), "args": {"ip": ip}})
+
+    def close(self) -> None:
+        self.f.write("\n]}\n")
+        self.f.close()
+
+
+def failure_reason(msg: str) -> str:
+    """Bucket a failure message, e.g. 'SSH connect failed: TimeoutError: timed out' -> 'SSH connect failed: TimeoutError'."""
+    parts = (msg or "unknown").split(": ")
+    if len(parts) > 2 and parts[1].isidentifier():
+        return f"{parts[0]}: {parts[1]}"
+    return parts[0]
+
+
+class LogHistogram:
+    """Counts per logarithmic bucket, so percentiles over millions of samples take a few hundred counters.
+
+    Bucket i covers [min_value * growth**i, min_value * growth**(i+1)); a
+    percentile reports its bucket's upper edge, clamped to the observed range.
+    """
+
+    def __init__(self, min_value: float = PHASE_HIST_MIN, growth: float = PHASE_HIST_GROWTH):
+        self.min_value = min_value
+        self.log_growth = math.log(growth)
+        self.growth = growth
+        self.counts: Dict[int, int] = {}
+        self.n = 0
+        self.lo = math.inf
+        self.hi = -math.inf
+
+    def add(self, value: float) -> None:
+        bucket = int(math.log(value / self.min_value) / self.log_growth) if value > self.min_value else -1
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.n += 1
+        self.lo = min(self.lo, value)
+        self.hi = max(self.hi, value)
+
+    def percentile(self, q: float) -> float:
+        """Nearest-rank percentile, q in (0, 1]."""
+        rank = max(1, math.ceil(q * self.n))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                upper = self.min_value * self.growth ** (bucket + 1)
+                return min(max(upper, self.lo), self.hi)
+        return self.hi
+
+
+class RunStats:
+    """Streaming counters for the summary; keeps only the first FAILURE_DETAILS_LIMIT failures."""
+
+    def __init__(self, details_limit: int = FAILURE_DETAILS_LIMIT):
+        self.processed = 0
+        self.succeeded = 0
+        self.unchanged = 0
+        self.failed = 0
+        self.drifted: List[str] = []
+        self.reasons: Dict[str, int] = {}
+        self.failure_details: List[Tuple[str, str]] = []
+        self.details_limit = details_limit
+        self.phase_hists: Dict[str, LogHistogram] = {}
+
+    def record(self, res: Dict[str, Any]) -> None:
+        self.processed += 1
+        for phase, seconds in res.get("timings", {}).items():
+            hist = self.phase_hists.get(phase)
+            if hist is None:
+                hist = self.phase_hists[phase] = LogHistogram()
+            hist.add(seconds)
+        if res.get("drifted"):
+            self.drifted.append(res["ip"])
+        if res.get("success"):
+            self.succeeded += 1
+            if res.get("unchanged"):
+                self.unchanged += 1
+            return
+        self.failed += 1
+        reason = failure_reason(res.get("msg", ""))
+        self.reasons[reason] = self.reasons.get(reason, 0) + 1
+        if len(self.failure_details) < self.details_limit:
+            self.failure_details.append((res["ip"], res.get("msg", "")))
+
+    def phase_percentiles(self) -> List[Tuple[str, int, float, float, float]]:
+        """(phase, n, p50, p95, p99) rows, nearest-rank percentiles to within PHASE_HIST_GROWTH."""
+        rows = []
+        order = list(PHASES) + sorted(set(self.phase_hists) - set(PHASES))
+        for phase in order:
+            hist = self.phase_hists.get(phase)
+            if hist is None:
+                continue
+            rows.append((phase, hist.n, hist.percentile(0.50), hist.percentile(0.95), hist.percentile(0.99)))
+        return rows
+
+
+# ---------------- snapshot store ----------------
+def snapshot_object_path(store_dir: str, sha: str) -> str:
+    return os.path.join(store_dir, "objects", sha[:2], sha[2:] + ".gz")
+
+
+def store_snapshot(store_dir: str, data: bytes) -> str:
+    """Add config bytes to the content-addressed store and return their sha256.
+
+    Identical configs map to the same object, so each distinct config is
+    compressed and written once. Writes go through a temp file + rename, so
+    workers racing on the same hash just replace it with identical bytes.
+    """
+    sha = hashlib.sha256(data).hexdigest()
+    path = snapshot_object_path(store_dir, sha)
+    if os.path.exists(path):
+        return sha
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(gzip.compress(data, mtime=0))
+    os.replace(tmp, path)
+    return sha
+
+
+def write_snapshot_manifest(store_dir: str, hosts: Dict[str, Dict[str, Any]], failed: List[str],
+                            taken_at: float) -> str:
+    """Write manifests/<UTC time>.json (and manifests/latest.json) mapping each host to its config hash."""
+    manifest = {
+        "taken_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(taken_at)),
+        "config_path": CONFIG_PATH_RAW,
+        "hosts": hosts,
+        "failed": failed,
+    }
+    manifest_dir = os.path.join(store_dir, "manifests")
+    os.makedirs(manifest_dir, exist_ok=True)
+    path = os.path.join(manifest_dir, time.strftime("%Y%m%dT%H%M%SZ", time.gmtime(taken_at)) + ".json")
+    for target in (path, os.path.join(manifest_dir, "latest.json")):
+        tmp = target + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp, target)
+    return path
+
+
+# ---------------- connection-pool daemon ----------------
+class TransportPool:
+    """Authenticated paramiko Transports kept open across jobs, keyed by (ip, port, username, password digest).
+
+    The password is part of the key so a job only ever reuses a session it could
+    have opened itself: a wrong or rotated password authenticates afresh (and
+    fails) instead of riding on an earlier job's login. Dropped transports are reconnected on the next acquire(); transports nobody is
+    using are closed after idle_timeout seconds by evict_idle().
+    """
+
+    def __init__(self, keepalive: int = DAEMON_KEEPALIVE, idle_timeout: float = DAEMON_IDLE_TIMEOUT):
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.entries: Dict[Tuple[str, int, str, str], Dict[str, Any]] = {}
+
+    @staticmethod
+    def key(ip: str, port: int, username: str, password: str) -> Tuple[str, int, str, str]:
+        return ip, port, username, hashlib.sha256(password.encode("utf-8")).hexdigest()
+
+    def acquire(self, ip: str, port: int, username: str, password: str,
+                timer: Optional[PhaseTimer] = None) -> paramiko.Transport:
+        key = self.key(ip, port, username, password)
+        with self.lock:
+            entry = self.entries.setdefault(key, {"lock": threading.Lock(), "transport": None,
+                                                  "last_used": 0.0, "in_use": 0})
+            entry["in_use"] += 1
+        try:
+            with entry["lock"]:
+                transport = entry["transport"]
+                if transport is None or not transport.is_active():
+                    if transport is not None:
+                        transport.close()
+                    entry["transport"] = None
+                    transport = open_transport(ip, port, username, password, timer)
+                    transport.set_keepalive(self.keepalive)
+                    entry["transport"] = transport
+                entry["last_used"] = time.monotonic()
+                return transport
+        except BaseException:
+            self.release(ip, port, username, password)
+            raise
+
+    def release(self, ip: str, port: int, username: str, password: str) -> None:
+        with self.lock:
+            entry = self.entries.get(self.key(ip, port, username, password))
+            if entry:
+                entry["in_use"] -= 1
+                entry["last_used"] = time.monotonic()
+
+    def evict_idle(self) -> int:
+        now = time.monotonic()
+        evicted = []
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                dead = entry["transport"] is None or not entry["transport"].is_active()
+                if entry["in_use"] == 0 and (dead or now - entry["last_used"] > self.idle_timeout):
+                    evicted.append(self.entries.pop(key)["transport"])
+        for transport in evicted:
+            if transport is not None:
+                transport.close()
+        return len(evicted)
+
+    def size(self) -> int:
+        with self.lock:
+            return sum(1 for e in self.entries.values() if e["transport"] is not None and e["transport"].is_active())
+
+    def close_all(self) -> None:
+        with self.lock:
+            entries, self.entries = list(self.entries.values()), {}
+        for entry in entries:
+            if entry["transport"] is not None:
+                entry["transport"].close()
+
+
+# Keys a --via-daemon client may set for process_host (everything except ip and pool)
+DAEMON_JOB_KEYS = ("username", "password", "port", "ops",
+                   "do_switchpool", "switch_method", "switch_timeout", "switch_if_changed",
+                   "drift_hash", "push_drifted", "snapshot_dir", "preserve_format",
+                   "remote_edit_mode", "probe_cache", "probe_ttl", "regions")
+
+
+def mono_to_wall_offset() -> float:
+    """Add to a time.monotonic() value to get wall-clock time (spans cross the daemon socket as wall time)."""
+    return time.time() - time.monotonic()
+
+
+class DaemonJobHandler(socketserver.StreamRequestHandler):
+    """One job per connection: a JSON header line, then one host per line until EOF.
+    Results are streamed back as JSON lines as they complete."""
+
+    def handle(self) -> None:
+        try:
+            header = json.loads(self.rfile.readline() or b"{}")
+        except ValueError as e:
+            self.wfile.write((json.dumps({"error": f"bad job header: {e}"}) + "\n").encode())
+            return
+        job = {k: v for k, v in header.get("job", {}).items() if k in DAEMON_JOB_KEYS}
+        try:
+            job["ops"] = ConfigOps(job.get("ops") or ())
+        except (ValueError, re.error) as e:
+            self.wfile.write((json.dumps({"error": f"bad ops: {e}"}) + "\n").encode())
+            return
+        job["pool"] = self.server.pool
+        workers = header.get("workers", DEFAULT_WORKERS)
+        controller = AimdController() if workers == "auto" else None
+
+        def hosts() -> Iterator[Any]:
+            for line in self.rfile:
+                target = line.decode("utf-8", errors="ignore").strip()
+                if target.startswith("["):
+                    ip, overrides = json.loads(target)  # inventory host: [ip, {port/username/password}]
+                    yield ip, {k: v for k, v in overrides.items() if k in ("port", "username", "password")}
+                elif target:
+                    yield target
+
+        offset = mono_to_wall_offset()
+        if controller:
+            results = run_adaptive_thread_engine(hosts(), job, controller)
+        else:
+            results = run_thread_engine(hosts(), job, int(workers))
+        for res in results:
+            res["spans"] = [(name, start + offset, end + offset) for name, start, end in res.get("spans", [])]
+            self.wfile.write((json.dumps(res, default=str) + "\n").encode())
+            self.wfile.flush()
+        if controller:
+            self.wfile.write((json.dumps({"concurrency": controller.report()}) + "\n").encode())
+        save_capability_caches()
+
+
+class PoolDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, pool: TransportPool):
+        self.pool = pool
+        super().__init__(socket_path, DaemonJobHandler)
+
+
+def run_daemon(socket_path: str, keepalive: int, idle_timeout: float) -> None:
+    """Serve process_host jobs on a Unix socket, keeping SSH transports to the fleet warm."""
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except OSError:
+            os.unlink(socket_path)  # stale socket from a daemon that did not shut down cleanly
+        else:
+            print(f"Error: a daemon is already listening on {socket_path}", file=sys.stderr)
+            sys.exit(2)
+        finally:
+            probe.close()
+    pool = TransportPool(keepalive=keepalive, idle_timeout=idle_timeout)
+    server = PoolDaemon(socket_path, pool)
+    os.chmod(socket_path, 0o600)  # jobs carry the SSH password
+
+    stop = threading.Event()
+
+    def evictor() -> None:
+        while not stop.wait(DAEMON_EVICT_INTERVAL):
+            pool.evict_idle()
+
+    threading.Thread(target=evictor, name="pool-evictor", daemon=True).start()
+    # SIGTERM (service managers, kill) shuts down through the same cleanup as Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"Daemon listening on {socket_path} (keepalive={keepalive}s, idle-timeout={idle_timeout:g}s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+        pool.close_all()
+        try:
+            os.unlink(socket_path)
+        except OSError:
+            pass
+
+
+def run_via_daemon(socket_path: str, hosts: Iterable[Any], job_kwargs: Dict[str, Any],
+                   workers: Any, controller: Optional[AimdController] = None) -> Iterator[Dict[str, Any]]:
+    """Hand the job to a running --daemon and yield its results like a local engine.
+    With --workers auto the daemon runs the AIMD controller and its report lands in controller."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    header = {"workers": workers, "job": {k: job_kwargs[k] for k in DAEMON_JOB_KEYS if k in job_kwargs}}
+
+    def send() -> None:
+        # Separate thread: the daemon streams results while we are still sending hosts
+        try:
+            with sock.makefile("wb") as w:
+                w.write((json.dumps(header, default=lambda o: o.spec()) + "\n").encode())  # ConfigOps go as spec()
+                for target in hosts:
+                    w.write(((target if isinstance(target, str) else json.dumps(target)) + "\n").encode())
+                    w.flush()
+            sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    threading.Thread(target=send, name="daemon-send", daemon=True).start()
+    offset = mono_to_wall_offset()
+    try:
+        with sock.makefile("rb") as r:
+            for line in r:
+                res = json.loads(line)
+                if "error" in res and "ip" not in res:
+                    raise RuntimeError(f"daemon: {res['error']}")
+                if "concurrency" in res and "ip" not in res:
+                    if controller:
+                        controller.imported = res["concurrency"]
+                    continue
+                res["spans"] = [(name, start - offset, end - offset) for name, start, end in res.get("spans", [])]
+                yield res
+    finally:
+        sock.close()
+
+
 # ---------------- main / CLI ----------------
+def positive_int(value: str) -> int:
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a number, got {value!r}") from None
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return number
+
+
+def workers_arg(value: str) -> Any:
+    if value == "auto":
+        return value
+    if not value.lstrip("-").isdigit():
+        raise argparse.ArgumentTypeError(f"expected a number or 'auto', got {value!r}")
+    return positive_int(value)
+
+
 def main():
-    p = argparse.ArgumentParser(description="Bulk update ccminer config 'pools' and optionally call switchpool (telnet).")
-    group = p.add_mutually_exclusive_group(required=True)
-    group.add_argument("--range", help="IP range (inclusive), e.g. 10.10.10.100-10.10.10.150")
-    group.add_argument("--cidr", help="CIDR block, e.g. 10.10.10.0/24")
-    p.add_argument("--username", required=True, help="SSH username")
-    p.add_argument("--password", required=True, help="SSH password")
+    p = argparse.ArgumentParser(description="Bulk update ccminer config 'pools' and optionally call switchpool.")
+    p.add_argument("--range", action="append",
+                   help="IP range (inclusive), e.g. 10.10.10.100-10.10.10.150, or a single IP (repeatable)")
+    p.add_argument("--cidr", action="append", help="CIDR block, e.g. 10.10.10.0/24 (repeatable)")
+    p.add_argument("--exclude", action="append", metavar="RANGE|CIDR|IP",
+                   help="Leave these hosts out of --range/--cidr/--inventory (repeatable)")
+    p.add_argument("--inventory", metavar="CSV",
+                   help="Host inventory CSV (ip, optional port/username/password overrides, tags, attributes)")
+    p.add_argument("--select", action="append", metavar="KEY=VALUE,...",
+                   help="With --inventory: hosts matching every term, e.g. tag=rack3,model=s9 (repeatable: any match)")
+    p.add_argument("--username", help="SSH username")
+    p.add_argument("--password", help="SSH password")
     p.add_argument("--port", type=int, default=DEFAULT_SSH_PORT, help=f"SSH port (default {DEFAULT_SSH_PORT})")
-    p.add_argument("--disable-url", help="Pool URL to set disabled=1")
-    p.add_argument("--enable-url", help="Pool URL to set disabled=0")
+    p.add_argument("--disable-url", action="append", help="Pool URL to set disabled=1 (repeatable)")
+    p.add_argument("--enable-url", action="append", help="Pool URL to set disabled=0 (repeatable)")
+    p.add_argument("--disable-match", action="append", metavar="SELECTOR",
+                   help="Disable every pool whose URL matches: a glob ('stratum+tcp://*.vipor.net:*'), 're:<regex>' or "
+                        "'host:<name>'; compared after normalizing case, scheme and trailing slashes (repeatable)")
+    p.add_argument("--enable-match", action="append", metavar="SELECTOR",
+                   help="Enable every pool whose URL matches, same syntax as --disable-match (repeatable)")
+    p.add_argument("--ops-file", help="File of 'disable|enable|disable-match|enable-match <url>' lines, "
+                                      "applied together with the flags")
     p.add_argument("--set-pools-json", help="Path to JSON file containing replacement pools list")
+    p.add_argument("--regions", metavar="FILE",
+                   help='JSON object of "<cidr>": "<region>" (plus an optional "*" default) for ${region} in templates')
+    p.add_argument("--patch", metavar="FILE",
+                   help="JSON array of RFC 6902-style ops (add/replace/remove/test, plus enable-pools/disable-pools "
+                        "with a 'match'), applied after the URL flags")
+    p.add_argument("--set", action="append", metavar="PATH=VALUE",
+                   help="Set a config key, e.g. --set threads=8 or --set /pools/0/pass=x; VALUE is JSON, "
+                        "else a string (repeatable)")
+    p.add_argument("--preserve-format", action="store_true",
+                   help="Splice only the changed values into config.json instead of re-serializing it; "
+                        "same-length edits are patched in place on the host")
+    p.add_argument("--remote-edit", action="store_true",
+                   help="Edit config.json on the host with python or jq in one exec (backup + atomic rename there); "
+                        "hosts without either use the normal read/write path")
+    p.add_argument("--check-drift", action="store_true",
+                   help="Only report hosts whose pools differ from --set-pools-json (compares a remote hash, writes nothing)")
+    p.add_argument("--push-drifted", action="store_true",
+                   help="With --check-drift, write --set-pools-json to the drifted hosts")
+    p.add_argument("--pull", action="store_true",
+                   help="Snapshot config.json from every host into the local store (--store) instead of changing anything")
+    p.add_argument("--store", default=DEFAULT_SNAPSHOT_STORE,
+                   help=f"Snapshot store directory for --pull (default {DEFAULT_SNAPSHOT_STORE})")
     p.add_argument("--switch-pool", action="store_true", help="Send 'switchpool' to localhost:4068 on the remote host")
-    p.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help=f"Concurrent SSH workers (default {DEFAULT_WORKERS})")
+    p.add_argument("--switch-if-changed", action="store_true",
+                   help="With --switch-pool, skip switchpool on hosts whose config was already up to date")
+    p.add_argument("--switch-method", choices=["auto", "tunnel", "telnet", "nc"], default="auto",
+                   help="How to reach the ccminer API: SSH direct-tcpip tunnel, remote telnet or nc, "
+                        "or tunnel with telnet fallback (default auto; with --probe, the best the host supports)")
+    p.add_argument("--switchpool-timeout", type=float, default=SWITCHPOOL_TIMEOUT,
+                   help=f"Seconds to wait for the ccminer API reply over the tunnel (default {SWITCHPOOL_TIMEOUT})")
+    p.add_argument("--probe", action="store_true",
+                   help="Probe each host once for telnet/nc/python/jq/dd and TCP forwarding, cache the result "
+                        "(--probe-cache) and pick switchpool/edit methods from it")
+    p.add_argument("--probe-cache", default=DEFAULT_PROBE_CACHE,
+                   help=f"Capability cache file for --probe, checked against each host key fingerprint (default {DEFAULT_PROBE_CACHE})")
+    p.add_argument("--probe-ttl", type=float, default=PROBE_TTL,
+                   help=f"Seconds before --probe re-checks a host (default {PROBE_TTL})")
+    p.add_argument("--workers", type=workers_arg, default=DEFAULT_WORKERS,
+                   help=f"Concurrent SSH workers (default {DEFAULT_WORKERS}), or 'auto' to tune them per /24 with AIMD "
+                        f"(thread engine, up to {AIMD_MAX_WORKERS} in flight)")
+    p.add_argument("--schedule", choices=["lpt", "ip"], default="lpt",
+                   help=f"Submission order: longest expected run time first from --history within windows of "
+                        f"{LPT_WINDOW} hosts (default; off with --prescan, which runs hosts as they answer), or IP order")
+    p.add_argument("--history", default=DEFAULT_HISTORY,
+                   help=f"Per-host durations from earlier runs, for --schedule lpt (default {DEFAULT_HISTORY})")
+    p.add_argument("--dead-cache", default=DEFAULT_DEAD_CACHE,
+                   help=f"Where recent unreachable (ip, port) pairs are kept (default {DEFAULT_DEAD_CACHE})")
+    p.add_argument("--include-dead", action="store_true",
+                   help="Also try hosts still backing off after earlier connect failures (they go last)")
+    p.add_argument("--prescan", action="store_true",
+                   help="TCP-connect to --port on every target first and only SSH to hosts that answer")
+    p.add_argument("--prescan-timeout", type=float, default=PRESCAN_TIMEOUT,
+                   help=f"Per-host connect timeout for --prescan in seconds (default {PRESCAN_TIMEOUT})")
+    p.add_argument("--prescan-concurrency", type=positive_int, default=PRESCAN_CONCURRENCY,
+                   help=f"Connects in flight during --prescan (default {PRESCAN_CONCURRENCY})")
+    p.add_argument("--results-out", metavar="FILE",
+                   help="Write every host result to FILE as JSON lines while the run progresses")
+    p.add_argument("--trace", metavar="FILE",
+                   help="Write a Chrome/Perfetto trace (Trace Event Format JSON) of every host phase per worker")
+    p.add_argument("--engine", choices=["threads", "asyncio"], default="threads",
+                   help="Execution engine: one thread per host (default) or a single asyncio event loop (needs asyncssh)")
+    p.add_argument("--concurrency", type=positive_int, default=DEFAULT_ASYNC_CONCURRENCY,
+                   help=f"Max hosts in flight with --engine asyncio (default {DEFAULT_ASYNC_CONCURRENCY}; "
+                        f"capped to what the open-files limit allows)")
+    p.add_argument("--daemon", action="store_true",
+                   help="Run as a connection-pool daemon on --socket, keeping SSH sessions to the fleet open between jobs")
+    p.add_argument("--via-daemon", action="store_true",
+                   help="Send this run to the daemon listening on --socket instead of connecting directly")
+    p.add_argument("--socket", default=DEFAULT_DAEMON_SOCKET,
+                   help=f"Unix socket for --daemon / --via-daemon (default {DEFAULT_DAEMON_SOCKET})")
+    p.add_argument("--keepalive", type=int, default=DAEMON_KEEPALIVE,
+                   help=f"--daemon: seconds between SSH keepalives (default {DAEMON_KEEPALIVE})")
+    p.add_argument("--idle-timeout", type=float, default=DAEMON_IDLE_TIMEOUT,
+                   help=f"--daemon: close sessions idle for this many seconds (default {DAEMON_IDLE_TIMEOUT})")
     args = p.parse_args()
 
-    if not any([args.disable_url, args.enable_url, args.set_pools_json, args.switch_pool]):
-        print("Error: specify at least one action: --disable-url, --enable-url, --set-pools-json, or --switch-pool", file=sys.stderr)
+    # Expected channel-open failures (switchpool tunnel fallback) would otherwise hit logging's lastResort handler
+    logging.getLogger("paramiko").addHandler(logging.NullHandler())
+
+    if (args.daemon or args.via_daemon) and not hasattr(socket, "AF_UNIX"):
+        print("Error: --daemon/--via-daemon need Unix domain sockets (not available on this platform)", file=sys.stderr)
         sys.exit(2)
 
+    if args.daemon:
+        run_daemon(args.socket, args.keepalive, args.idle_timeout)
+        return
+
+    if not (args.range or args.cidr or args.inventory):
+        p.error("one of the arguments --range --cidr --inventory is required")
+    if args.inventory and (args.range or args.cidr):
+        p.error("--inventory cannot be combined with --range/--cidr (use --select/--exclude)")
+    if args.select and not args.inventory:
+        p.error("--select requires --inventory")
+    if not args.inventory and (args.username is None or args.password is None):
+        p.error("--username and --password are required")
+
+    if args.workers == "auto" and args.engine == "asyncio":
+        p.error("--workers auto tunes the thread engine; use --concurrency with --engine asyncio")
+    if args.push_drifted and not args.check_drift:
+        p.error("--push-drifted requires --check-drift")
+    if args.remote_edit and args.preserve_format:
+        p.error("--remote-edit re-serializes on the host and cannot be combined with --preserve-format")
+    if args.check_drift and not args.set_pools_json:
+        p.error("--check-drift requires --set-pools-json (the desired pools)")
+    url_ops = {"disable": set(args.disable_url or []), "enable": set(args.enable_url or []),
+               "disable-match": set(args.disable_match or []), "enable-match": set(args.enable_match or [])}
+    if args.ops_file:
+        try:
+            for verb, items in load_ops_file(args.ops_file).items():
+                url_ops[verb] |= items
+        except (OSError, ValueError) as e:
+            print(f"Failed to load --ops-file: {e}", file=sys.stderr)
+            sys.exit(2)
+    both = (url_ops["disable"] & url_ops["enable"]) | (url_ops["disable-match"] & url_ops["enable-match"])
+    if both:
+        p.error(f"URL(s) both disabled and enabled: {', '.join(sorted(both))}")
     try:
-        if args.range:
-            hosts = expand_range(args.range)
-        else:
-            hosts = expand_cidr(args.cidr)
-    except Exception as e:
-        print(f"Invalid range/cidr: {e}", file=sys.stderr)
+        # Compiled once; a pool matching both sides is disabled
+        disable_urls = UrlMatcher(url_ops["disable"], url_ops["disable-match"])
+        enable_urls = UrlMatcher(url_ops["enable"], url_ops["enable-match"])
+    except re.error as e:
+        p.error(f"bad re: selector: {e}")
+
+    extra_ops: List[Dict[str, Any]] = []
+    if args.patch:
+        try:
+            extra_ops.extend(load_patch_file(args.patch))
+        except (OSError, ValueError) as e:
+            print(f"Failed to load --patch: {e}", file=sys.stderr)
+            sys.exit(2)
+    for item in args.set or []:
+        try:
+            extra_ops.append(parse_set_arg(item))
+        except ValueError as e:
+            p.error(f"--set: {e}")
+
+    if args.check_drift and (disable_urls or enable_urls or extra_ops):
+        p.error("--check-drift cannot be combined with --disable-url/--enable-url/--disable-match/--enable-match/"
+                "--patch/--set")
+
+    if args.pull and any([disable_urls, enable_urls, extra_ops, args.set_pools_json, args.switch_pool]):
+        p.error("--pull only reads; run changes separately")
+
+    if not any([disable_urls, enable_urls, extra_ops, args.set_pools_json, args.switch_pool, args.pull]):
+        print("Error: specify at least one action: --disable-url, --enable-url, --disable-match, --enable-match, "
+              "--ops-file, --set-pools-json, --patch, --set, --switch-pool, or --pull", file=sys.stderr)
         sys.exit(2)
 
+    if args.engine == "asyncio" and asyncssh is None:
+        print("Error: --engine asyncio requires the asyncssh package (pip install asyncssh)", file=sys.stderr)
+        sys.exit(2)
+
+    if args.inventory:
+        try:
+            inventory = Inventory(args.inventory)
+            selects = [parse_select(s) for s in args.select or []]
+            select_start = time.monotonic()
+            target_count = inventory.count(selects)
+            select_ms = (time.monotonic() - select_start) * 1000
+            for field in ("username", "password"):
+                if getattr(args, field) is None and inventory.count(selects, missing=field):
+                    p.error(f"{inventory.count(selects, missing=field)} selected hosts have no {field} in the "
+                            f"inventory; pass --{field}")
+        except (OSError, ValueError, csv.Error) as e:
+            print(f"Invalid --inventory/--select: {e}", file=sys.stderr)
+            sys.exit(2)
+        print(f"Inventory: {inventory.size} hosts loaded in {inventory.load_seconds * 1000:.0f} ms, "
+              f"{target_count} selected in {select_ms:.1f} ms")
+        hosts = inventory.targets(selects)
+        if args.exclude:
+            try:
+                excluded = AddressSet(args.exclude, hosts_only=False)
+            except ValueError as e:
+                print(f"Invalid --exclude: {e}", file=sys.stderr)
+                sys.exit(2)
+            target_count = sum(1 for ip, _ in inventory.targets(selects) if ip not in excluded)
+            hosts = (target for target in hosts if target[0] not in excluded)
+    else:
+        try:
+            # Every include/exclude spec merged into one interval set: overlaps are processed once
+            targets = AddressSet((args.range or []) + (args.cidr or []), args.exclude or [])
+        except Exception as e:
+            print(f"Invalid range/cidr/exclude: {e}", file=sys.stderr)
+            sys.exit(2)
+        target_count = targets.size()
+        hosts = iter(targets)
+
     new_pools = None
     if args.set_pools_json:
         try:
@@ -291,54 +3575,204 @@ def main():
             print(f"Failed to load --set-pools-json: {e}", file=sys.stderr)
             sys.exit(2)
 
-    total = len(hosts)
+    try:
+        # The URL flags and --set-pools-json are sugar for pool ops; everything is compiled once here
+        ops = ConfigOps.from_flags(disable_urls, enable_urls, new_pools, extra=extra_ops)
+    except (ValueError, re.error) as e:
+        print(f"Invalid op (--set-pools-json/--patch/--set): {e}", file=sys.stderr)
+        sys.exit(2)
+
+    regions = os.path.abspath(os.path.expanduser(args.regions)) if args.regions else None
+    if "region" in ops.template_names and not regions:
+        p.error("${region} in a template needs --regions")
+    if regions:
+        try:
+            region_map(regions)
+        except (OSError, ValueError) as e:
+            print(f"Failed to load --regions: {e}", file=sys.stderr)
+            sys.exit(2)
+
+    drift_hash = pools_hash(ops.op_value(0)) if args.check_drift else None  # --check-drift: the lone add /pools
+
+    start_time = time.time()
+    run_start_mono = time.monotonic()
+
+    total = target_count
     if total == 0:
         print("No hosts found to process.", file=sys.stderr)
         sys.exit(0)
 
-    print(f"Starting: {total} hosts, workers={args.workers}, ssh-port={args.port}")
-    start_time = time.time()
+    history = HostHistory(os.path.abspath(os.path.expanduser(args.history)))
+    if args.schedule == "lpt" and history.entries and not args.prescan:
+        hosts = lpt_order(hosts, history, args.port)
+        print(f"Schedule: longest first within each {LPT_WINDOW} hosts ({len(history.entries)} hosts with history)")
+    dead_cache = DeadHostCache(os.path.abspath(os.path.expanduser(args.dead_cache)))
+    skipped_dead: List[str] = []
+    hosts = skip_dead_hosts(hosts, dead_cache, args.port, skipped_dead, args.include_dead)
+
+    def prescan_dead(ip: str, port: int, error: BaseException) -> None:
+        if unreachable_error(error):
+            dead_cache.record_failure(ip, port, f"no answer during pre-scan: {type(error).__name__}")
+
+    skipped = HostRuns()
+    if args.prescan:
+        hosts = prescan_hosts(hosts, args.port, skipped, args.prescan_timeout, args.prescan_concurrency,
+                              prescan_dead)
+
+    job_kwargs = dict(username=args.username, password=args.password, port=args.port,
+                      ops=ops,
+                      do_switchpool=args.switch_pool, switch_method=args.switch_method,
+                      switch_timeout=args.switchpool_timeout, switch_if_changed=args.switch_if_changed,
+                      drift_hash=drift_hash, push_drifted=args.push_drifted,
+                      snapshot_dir=os.path.abspath(os.path.expanduser(args.store)) if args.pull else None,
+                      preserve_format=args.preserve_format, remote_edit_mode=args.remote_edit,
+                      probe_cache=os.path.abspath(os.path.expanduser(args.probe_cache)) if args.probe else None,
+                      probe_ttl=args.probe_ttl, regions=regions)
+    controller = AimdController() if args.workers == "auto" else None
+    if args.via_daemon:
+        print(f"Starting: {total} hosts, via daemon {args.socket}, workers={args.workers}, ssh-port={args.port}")
+        result_iter = run_via_daemon(args.socket, hosts, job_kwargs, args.workers, controller)
+    elif args.engine == "asyncio":
+        print(f"Starting: {total} hosts, engine=asyncio, concurrency={args.concurrency}, ssh-port={args.port}")
+        result_iter = run_asyncio_engine(hosts, job_kwargs, args.concurrency)
+    elif controller:
+        print(f"Starting: {total} hosts, workers=auto (AIMD per segment, start {controller.start}, "
+              f"max {controller.max_workers} in flight), ssh-port={args.port}")
+        result_iter = run_adaptive_thread_engine(hosts, job_kwargs, controller)
+    else:
+        print(f"Starting: {total} hosts, workers={args.workers}, ssh-port={args.port}")
+        result_iter = run_thread_engine(hosts, job_kwargs, args.workers)
 
-    results = []
-    succeeded = 0
-    failed = 0
+    sink = None
+    if args.results_out:
+        try:
+            sink = ResultSink(args.results_out)
+        except OSError as e:
+            print(f"Cannot open --results-out: {e}", file=sys.stderr)
+            sys.exit(2)
 
-    with ThreadPoolExecutor(max_workers=args.workers) as ex:
-        future_to_ip = {
-            ex.submit(process_host, ip, args.username, args.password, args.port,
-                      args.disable_url, args.enable_url, new_pools, args.switch_pool): ip
-            for ip in hosts
-        }
+    tracer = None
+    if args.trace:
+        try:
+            tracer = TraceWriter(args.trace, run_start_mono)
+        except OSError as e:
+            print(f"Cannot open --trace: {e}", file=sys.stderr)
+            sys.exit(2)
 
-        for i, fut in enumerate(as_completed(future_to_ip), 1):
-            ip = future_to_ip[fut]
-            try:
-                res = fut.result()
-            except Exception as e:
-                res = {"ip": ip, "success": False, "updated": False, "switched": False, "msg": f"executor error: {e}"}
-            results.append(res)
-            if res.get("success"):
-                succeeded += 1
-                status = "OK"
+    snapshots: Dict[str, Dict[str, Any]] = {}
+    pull_failed: List[str] = []
+    stats = RunStats()
+    try:
+        for res in result_iter:
+            spans = res.pop("spans", None)
+            worker = res.pop("worker", "worker")
+            if tracer and spans:
+                tracer.add_host(res["ip"], worker, spans)
+            stats.record(res)
+            if res.get("unreachable"):
+                dead_cache.record_failure(res["ip"], res.get("port", args.port), res.get("msg", ""))
             else:
-                failed += 1
-                status = "FAIL"
-            print(f"[{i}/{total}] {ip} {status} - {res.get('msg', '')}")
+                dead_cache.record_alive(res["ip"], res.get("port", args.port))
+                if "total" in res.get("timings", {}):
+                    history.record(res["ip"], res.get("port", args.port), res["timings"]["total"])
+            if args.pull:
+                if res.get("success"):
+                    snapshots[res["ip"]] = {"sha256": res["sha256"], "size": res["size"]}
+                else:
+                    pull_failed.append(res["ip"])
+            if sink:
+                sink.write(res)
+            if drift_hash and res.get("success") and not res.get("drifted"):
+                continue  # --check-drift: only drifted and failed hosts are worth a line
+            status = "OK" if res.get("success") else "FAIL"
+            print(f"[{stats.processed}/{total}] {res['ip']} {status} - {res.get('msg', '')}")
+    finally:
+        if sink:
+            sink.close()
+        if tracer:
+            tracer.close()
+        save_capability_caches()
+        for state, name in ((dead_cache, "dead-host cache"), (history, "history")):
+            try:
+                state.save()
+            except OSError as e:
+                print(f"Cannot write {name} {state.path}: {e}", file=sys.stderr)
+
+    manifest_path = None
+    if args.pull:
+        try:
+            manifest_path = write_snapshot_manifest(job_kwargs["snapshot_dir"], snapshots, pull_failed, start_time)
+        except OSError as e:
+            print(f"Cannot write snapshot manifest: {e}", file=sys.stderr)
 
     elapsed = time.time() - start_time
     print("\n=== Summary ===")
-    print(f"Total hosts : {total}")
-    print(f"Successes   : {succeeded}")
-    print(f"Failures    : {failed}")
+    print(f"Total hosts : {stats.processed + len(skipped) + len(skipped_dead)}")
+    print(f"Successes   : {stats.succeeded}")
+    if drift_hash:
+        rendered = "per-host templates" if ops.template_names else f"pools sha256 {drift_hash[:12]}"
+        print(f"In sync     : {stats.unchanged} ({rendered})")
+        print(f"Drifted     : {len(stats.drifted)}" + (" (pushed)" if args.push_drifted else ""))
+    elif stats.unchanged:
+        print(f"Unchanged   : {stats.unchanged} (already up to date, nothing written)")
+    print(f"Failures    : {stats.failed}")
+    if args.prescan:
+        print(f"Skipped     : {len(skipped)} (no answer on port {args.port} during pre-scan)")
+    if skipped_dead:
+        print(f"Backing off : {len(skipped_dead)} (unreachable on recent runs; --include-dead to try them)")
     print(f"Elapsed     : {elapsed:.2f}s")
+    if args.pull:
+        unique = len({entry["sha256"] for entry in snapshots.values()})
+        print(f"Snapshots   : {len(snapshots)} hosts, {unique} distinct configs in {job_kwargs['snapshot_dir']}")
+        if manifest_path:
+            print(f"Manifest    : {manifest_path}")
+    if sink:
+        print(f"Results     : {args.results_out}")
+    if tracer:
+        print(f"Trace       : {args.trace}")
+    if ops.render_hits:
+        print(f"Templates   : {ops.render_misses} distinct renders, {ops.render_hits} hosts shared one")
+    if TRANSFORM_CACHE.hits:
+        print(f"Renders     : {TRANSFORM_CACHE.misses} distinct, {TRANSFORM_CACHE.hits} served from cache")
+
+    if controller and controller.report():
+        print(f"\n{'Segment':<20} {'hosts':>7} {'optimum':>8} {'final':>6} {'peak':>6} {'backoffs':>9} {'latency':>10}")
+        for row in controller.report():
+            baseline = f"{row['baseline']:.3f}s" if row["baseline"] is not None else "-"
+            print(f"{row['segment']:<20} {row['hosts']:>7} {row['optimum']:>8} {row['final']:>6} {row['peak']:>6} "
+                  f"{row['backoffs']:>9} {baseline:>10}")
+
+    phase_rows = stats.phase_percentiles()
+    if phase_rows:
+        print(f"\n{'Phase (s)':<12} {'n':>7} {'p50':>8} {'p95':>8} {'p99':>8}")
+        for phase, n, p50, p95, p99 in phase_rows:
+            print(f"{phase:<12} {n:>7} {p50:>8.3f} {p95:>8.3f} {p99:>8.3f}")
+
+    if stats.failed:
+        print("\nFailure reasons:")
+        for reason, count in sorted(stats.reasons.items(), key=lambda kv: -kv[1]):
+            print(f" {count:6d}  {reason}")
 
-    if failed:
         print("\nFailed hosts details:")
-        for r in results:
-            if not r.get("success"):
-                print(f" - {r['ip']}: {r.get('msg')}")
+        for ip, msg in stats.failure_details:
+            print(f" - {ip}: {msg}")
+        if stats.failed > len(stats.failure_details):
+            more = stats.failed - len(stats.failure_details)
+            print(f" ... and {more} more" + (f" (see {args.results_out})" if sink else ""))
+
+    if stats.drifted:
+        print("\nDrifted hosts:")
+        print(f" - {format_ip_runs(stats.drifted)}")
+
+    if skipped:
+        print("\nSkipped hosts (pre-scan):")
+        print(f" - {skipped.format()}")
+
+    if skipped_dead:
+        print("\nBacking-off hosts (not tried):")
+        print(f" - {format_ip_runs(skipped_dead)}")
 
-    sys.exit(0 if failed == 0 else 1)
+    sys.exit(0 if stats.failed == 0 and not skipped_dead else 1)
 
 
 if __name__ == "__main__":